@@ -10,7 +10,7 @@ from django.shortcuts import redirect
 from django.template.response import TemplateResponse
 
 from .models import (ReportedCase, Actor, SMS, InboundSMS, Email, Digest,
-                     Facility, OnaForm)
+                     Facility, OnaForm, DailyCaseRollup, OutboxMessage)
 from .tasks import (import_facilities, ona_fetch_reported_case_for_form,
                     compile_and_send_jembi)
 
@@ -29,8 +29,8 @@ class ReportedCaseAdmin(admin.ModelAdmin):
                     'create_date_time',
                     'form',
                     'ehp_report_link')
-    list_filter = ('facility_code', 'gender', 'create_date_time', 'form',
-                   'jembi_alert_sent')
+    list_filter = ('facility_code', 'gender', 'travel_country',
+                   'create_date_time', 'form', 'jembi_alert_sent')
     search_fields = ('case_number', 'first_name', 'last_name', 'sa_id_number')
 
     actions = ['send_jembi_alert']
@@ -93,6 +93,8 @@ class EmailAdmin(admin.ModelAdmin):
     list_display = ('to', 'created_at', 'email_link')
     list_filter = ('created_at',)
     search_fields = ('to',)
+    # The content is only loaded, and decompressed, by email_view
+    exclude = ('content',)
 
     def get_urls(self):
         urls = super(EmailAdmin, self).get_urls()
@@ -109,7 +111,8 @@ class EmailAdmin(admin.ModelAdmin):
     email_link.allow_tags = True
 
     def email_view(self, request, pk):
-        email = Email.objects.get(pk=pk)
+        email = Email.objects.select_related('content').only(
+            'content', 'content__html_content').get(pk=pk)
         return HttpResponse(email.html_content)
 
 
@@ -203,8 +206,8 @@ class FacilityUploadForm(forms.Form):
         'If the file is a json, the format must be a list of json objects '
         'with the keys the same as the csv headers')
     wipe = forms.BooleanField(
-        help_text=('Check if you want to wipe the existing database before '
-                   'importing new data.'), required=False)
+        help_text=('Check if you want to remove the existing facilities '
+                   'that are not in the file.'), required=False)
 
 
 class FacilityAdmin(admin.ModelAdmin):
@@ -263,12 +266,59 @@ class FacilityAdmin(admin.ModelAdmin):
             request, 'ona/upload_facility_codes.html', context)
 
 
+class DailyCaseRollupAdmin(admin.ModelAdmin):
+    date_hierarchy = 'date'
+    list_display = ('date',
+                    'facility_code',
+                    'district',
+                    'province',
+                    'gender',
+                    'age_band',
+                    'travel_country',
+                    'cases')
+    list_filter = ('province', 'district', 'gender', 'age_band',
+                   'travel_country')
+    search_fields = ('facility_code',)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    date_hierarchy = 'created_at'
+    list_display = ('task', 'args', 'kwargs', 'created_at', 'dispatched_at',
+                    'attempts', 'last_error')
+    list_filter = ('task', 'created_at', 'dispatched_at')
+    readonly_fields = ('task', 'args', 'kwargs', 'created_at',
+                       'claimed_at', 'dispatched_at', 'attempts',
+                       'last_error')
+    actions = ['retry_messages']
+
+    def retry_messages(self, request, queryset):
+        retried = queryset.filter(dispatched_at__isnull=True).update(
+            attempts=0, last_error='', claimed_at=None)
+        self.message_user(
+            request, 'Retrying %s undispatched messages.' % (retried,))
+    retry_messages.short_description = 'Retry selected undispatched messages.'
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class OnaFormAdmin(admin.ModelAdmin):
     date_hierarchy = 'created_at'
     list_display = ('title',
                     'id_string',
                     'form_id',
                     'active',
+                    'last_submission_id',
+                    'last_synced_at',
                     'created_at',
                     )
     actions = ['pull_reported_cases']
@@ -291,3 +341,5 @@ admin.site.register(Email, EmailAdmin)
 admin.site.register(Digest, DigestAdmin)
 admin.site.register(Facility, FacilityAdmin)
 admin.site.register(OnaForm, OnaFormAdmin)
+admin.site.register(DailyCaseRollup, DailyCaseRollupAdmin)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
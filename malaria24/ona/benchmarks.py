@@ -0,0 +1,232 @@
+"""
+Synthetic data and timing helpers for benchmarking the digests and
+the Ona importer.
+"""
+import random
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core import mail
+from django.db import connection, transaction
+from django.test import override_settings
+from django.utils import timezone
+
+from . import tasks
+from .fake_ona import FakeOnaServer
+from .models import (
+    Actor, Digest, DistrictDigest, Facility, NationalDigest, OnaForm,
+    ProvincialDigest, ReportedCase, MANAGER_DISTRICT, MANAGER_NATIONAL,
+    MANAGER_PROVINCIAL, MIS, PROVINCES, TRAVEL_COUNTRIES)
+
+ABROAD_ANSWERS = TRAVEL_COUNTRIES + ['No', 'no travel', 'Kenya', 'Malawi']
+
+
+def make_facilities(facilities, districts_per_province, rnd):
+    """
+    Creates ``facilities`` facilities spread over ``districts_per_province``
+    districts in every province and returns their facility codes.
+    """
+    districts = [
+        (province, '%s District %s' % (province, i + 1))
+        for province, _ in PROVINCES
+        for i in range(districts_per_province)]
+    codes = []
+    rows = []
+    for i in range(facilities):
+        province, district = districts[i % len(districts)]
+        code = '%06d' % (i + 1,)
+        codes.append(code)
+        rows.append(Facility(
+            facility_code=code,
+            facility_name='Facility %s' % (code,),
+            province=province,
+            district=district,
+            subdistrict='%s Subdistrict %s' % (district, rnd.randint(1, 3)),
+            phase='Phase %s' % (rnd.randint(1, 3),)))
+    Facility.objects.bulk_create(rows, batch_size=1000)
+    return codes
+
+
+def make_managers(managers_per_scope):
+    """
+    Creates MIS users and national, provincial and district managers.
+    """
+    actors = []
+    for i in range(managers_per_scope):
+        actors.append(Actor(
+            name='MIS %s' % (i,), role=MIS,
+            email_address='mis%s@example.org' % (i,)))
+        actors.append(Actor(
+            name='National manager %s' % (i,), role=MANAGER_NATIONAL,
+            email_address='national%s@example.org' % (i,)))
+        for province, _ in PROVINCES:
+            actors.append(Actor(
+                name='%s manager %s' % (province, i), role=MANAGER_PROVINCIAL,
+                province=province,
+                email_address='provincial%s@example.org' % (i,)))
+        for district in Facility.objects.values_list(
+                'district', flat=True).distinct():
+            actors.append(Actor(
+                name='%s manager %s' % (district, i), role=MANAGER_DISTRICT,
+                district=district,
+                email_address='district%s@example.org' % (i,)))
+    Actor.objects.bulk_create(actors)
+
+
+def make_cases(cases, facility_codes, rnd, batch_size=5000):
+    """
+    Creates ``cases`` undigested cases reported over the last week.
+    """
+    now = timezone.now()
+    created = 0
+    while created < cases:
+        batch = []
+        for i in range(created, min(created + batch_size, cases)):
+            birth_date = now.date() - timedelta(days=rnd.randint(0, 80 * 365))
+            case = ReportedCase(
+                first_name='First %s' % (i,),
+                last_name='Last %s' % (i,),
+                locality='Locality',
+                date_of_birth=birth_date.strftime(
+                    rnd.choice(['%Y-%m-%d', '%y%m%d'])),
+                create_date_time=now - timedelta(
+                    seconds=rnd.randint(0, 7 * 24 * 60 * 60)),
+                sa_id_number=None,
+                msisdn='+2782%07d' % (i % 10 ** 7,),
+                id_type='said',
+                abroad=rnd.choice(ABROAD_ANSWERS),
+                reported_by='+27821234567',
+                gender=rnd.choice(['female', 'male']),
+                facility_code=rnd.choice(facility_codes),
+                landmark='School',
+                _id=str(i),
+                _uuid=uuid.uuid4().hex,
+                _xform_id_string='benchmark')
+            # bulk_create doesn't call save(), which normally does this
+            case.normalize()
+            batch.append(case)
+        ReportedCase.objects.bulk_create(batch)
+        created += len(batch)
+    return created
+
+
+def make_national_dataset(facilities=3000, cases=10000,
+                          districts_per_province=6, managers_per_scope=2,
+                          seed=0):
+    """
+    Creates a national dataset of facilities, managers and undigested cases.
+    Cases are created with ``bulk_create`` so no alerts are sent for them.
+    """
+    rnd = random.Random(seed)
+    facility_codes = make_facilities(facilities, districts_per_province, rnd)
+    make_managers(managers_per_scope)
+    make_cases(cases, facility_codes, rnd)
+
+
+@contextmanager
+def measure(trace_memory=False):
+    """
+    Measures the seconds taken and the queries made in the block. With
+    ``trace_memory`` it also measures the peak memory in bytes that Python
+    allocated while it ran, which slows the block down several times.
+    """
+    result = {'queries': 0}
+
+    def count_query(execute, sql, params, many, context):
+        result['queries'] += 1
+        return execute(sql, params, many, context)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.time()
+    try:
+        with connection.execute_wrapper(count_query):
+            yield result
+    finally:
+        result['seconds'] = time.time() - start
+        if trace_memory:
+            _, result['peak_memory'] = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+
+def time_digest(name, send):
+    """
+    Runs ``send`` and returns how long it took, the number of queries
+    it made and the number of emails it sent.
+    """
+    outbox = len(getattr(mail, 'outbox', []))
+    with measure() as result:
+        send()
+    result.update({
+        'digest': name,
+        'emails': len(getattr(mail, 'outbox', [])) - outbox,
+    })
+    return result
+
+
+def send_digest():
+    digest = Digest.compile_digest()
+    if digest:
+        digest.send_digest_email()
+
+
+def benchmark_digests():
+    """
+    Times each of the digests in the order compile_and_send_digest_email
+    sends them.
+    """
+    return [
+        time_digest('national', lambda: (
+            NationalDigest.compile_digest().send_digest_email())),
+        time_digest('provincial', lambda: (
+            ProvincialDigest.compile_digest().send_digest_email())),
+        time_digest('district', lambda: (
+            DistrictDigest.compile_digest().send_digest_email())),
+        time_digest('digest', send_digest),
+    ]
+
+
+def benchmark_ingestion(submissions=10000, forms=1, page_size=None,
+                        facility_codes=None, trace_memory=False):
+    """
+    Imports ``submissions`` synthetic submissions spread over ``forms``
+    forms with ona_fetch_reported_cases, from a fake Ona server running
+    in another process. Only the fake forms are active while it runs.
+
+    It has to run inside a transaction that is rolled back afterwards, as
+    the benchmark_ingestion command does. The new case alerts are then
+    queued in the outbox like they normally are, but the outbox is only
+    dispatched on commit so no SMSs or emails are sent.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError(
+            'benchmark_ingestion must run in a transaction that is '
+            'rolled back.')
+    overrides = {'CELERY_ALWAYS_EAGER': True}
+    if page_size:
+        overrides['ONA_DATA_PAGE_SIZE'] = page_size
+    try:
+        with FakeOnaServer(forms=forms, submissions=submissions,
+                           facility_codes=facility_codes) as server, \
+                override_settings(ONA_API_URL=server.url, **overrides):
+            # The session is mounted for the configured ONA_API_URL
+            tasks._ona_session = None
+            tasks.ona_fetch_forms()
+            form_ids = [str(form['formid']) for form in server.httpd.forms]
+            OnaForm.objects.exclude(form_id__in=form_ids).update(active=False)
+            OnaForm.objects.filter(form_id__in=form_ids).update(active=True)
+            with measure(trace_memory=trace_memory) as result:
+                tasks.ona_fetch_reported_cases()
+    finally:
+        tasks._ona_session = None
+
+    imported = ReportedCase.objects.filter(form__form_id__in=form_ids).count()
+    result.update({
+        'submissions': imported,
+        'submissions_per_second': imported / result['seconds'],
+        'queries_per_submission': result['queries'] / max(imported, 1),
+    })
+    return result
@@ -0,0 +1,163 @@
+"""
+A local stand-in for the parts of the Ona API that we use, for
+benchmarking the importer without touching the real service.
+"""
+import copy
+import json
+import multiprocessing
+import pkg_resources
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.utils import timezone
+
+
+def load_fixture(name):
+    return json.loads(pkg_resources.resource_string(
+        'malaria24', 'ona/fixtures/responses/%s' % (name,)))
+
+
+def generate_submissions(count, start_id=1, facility_codes=None, seed=0):
+    """
+    Returns ``count`` submissions modelled on the ones in ``data.json``,
+    with ascending ``_id`` values starting at ``start_id``.
+    """
+    templates = load_fixture('data.json')
+    now = timezone.now()
+    submissions = []
+    for i in range(count):
+        submission = copy.deepcopy(templates[i % len(templates)])
+        submission_id = start_id + i
+        submission.update({
+            '_id': submission_id,
+            '_uuid': uuid.UUID(int=(seed << 64) + submission_id).hex,
+            'case_number': '%s-%s' % (
+                now.strftime('%Y%m%d'), submission_id),
+            'create_date_time': (now - timedelta(minutes=i)).isoformat(),
+        })
+        if facility_codes:
+            submission['facility_code'] = facility_codes[
+                i % len(facility_codes)]
+        submissions.append(submission)
+    return submissions
+
+
+class FakeOnaHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(
+            (key, values[0]) for key, values in parse_qs(url.query).items())
+        parts = url.path.strip('/').split('/')
+        if parts == ['api', 'v1', 'forms']:
+            return self.get_forms()
+        if parts[:3] == ['api', 'v1', 'data'] and len(parts) == 4:
+            return self.get_data(parts[3], params)
+        self.send_json({'detail': 'Not found.'}, status=404)
+
+    def get_forms(self):
+        etag = '"%s"' % (self.server.forms_version,)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_json(self.server.forms, headers={'ETag': etag})
+
+    def get_data(self, form_id, params):
+        submissions = self.server.submissions.get(form_id)
+        if submissions is None:
+            return self.send_json({'detail': 'Not found.'}, status=404)
+        if 'query' in params:
+            since_id = json.loads(params['query'])['_id']['$gt']
+            submissions = [data for data in submissions
+                           if data['_id'] > since_id]
+        if 'page_size' not in params:
+            return self.send_json(submissions)
+        page = int(params.get('page', 1))
+        page_size = int(params['page_size'])
+        start = (page - 1) * page_size
+        # Like Ona, a page past the end of the results is a 404
+        if page > 1 and start >= len(submissions):
+            return self.send_json({'detail': 'Invalid page.'}, status=404)
+        self.send_json(submissions[start:start + page_size])
+
+
+class FakeOnaServer(object):
+    """
+    Serves ``/api/v1/forms`` and paginated ``/api/v1/data/<form_id>``
+    from memory on a local port, seeded from the ``forms.json`` fixture.
+    It serves from a forked process, so that its work isn't counted
+    against the importer, and forms and submissions have to be added
+    before it is started::
+
+        with FakeOnaServer(forms=2, submissions=1000) as server:
+            with override_settings(ONA_API_URL=server.url):
+                ...
+    """
+
+    def __init__(self, forms=1, submissions=0, facility_codes=None):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeOnaHandler)
+        self.httpd.forms = []
+        self.httpd.forms_version = 0
+        self.httpd.submissions = {}
+        [template] = load_fixture('forms.json')
+        for i in range(forms):
+            form = dict(template)
+            form.update({
+                'uuid': '%s-%s' % (template['uuid'], i),
+                'id_string': '%s-%s' % (template['id_string'], i),
+                'formid': template['formid'] + i,
+            })
+            self.add_form(form)
+        for i, form in enumerate(self.httpd.forms):
+            self.add_submissions(form['formid'], generate_submissions(
+                submissions // forms + (i < submissions % forms),
+                facility_codes=facility_codes, seed=i))
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def add_form(self, form):
+        self.httpd.forms.append(form)
+        self.httpd.forms_version += 1
+        self.httpd.submissions.setdefault(str(form['formid']), [])
+
+    def add_submissions(self, form_id, submissions):
+        existing = self.httpd.submissions[str(form_id)]
+        existing.extend(submissions)
+        existing.sort(key=lambda data: data['_id'])
+
+    def start(self):
+        self.process = multiprocessing.get_context('fork').Process(
+            target=self.httpd.serve_forever)
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from malaria24.ona.benchmarks import benchmark_digests, make_national_dataset
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Times the digests against a synthetic national dataset. '
+            'Everything is rolled back and no emails are sent.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--facilities', type=int, default=3000)
+        parser.add_argument('--cases', type=int, default=10000)
+        parser.add_argument('--districts-per-province', type=int, default=6)
+        parser.add_argument('--managers', type=int, default=2,
+                            help='Managers per province and district.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            with override_settings(
+                    EMAIL_BACKEND=(
+                        'django.core.mail.backends.locmem.EmailBackend')), \
+                    transaction.atomic():
+                start = time.time()
+                make_national_dataset(
+                    facilities=options['facilities'],
+                    cases=options['cases'],
+                    districts_per_province=options['districts_per_province'],
+                    managers_per_scope=options['managers'],
+                    seed=options['seed'])
+                self.stdout.write(
+                    'Created %s facilities and %s cases in %.2f seconds.' % (
+                        options['facilities'], options['cases'],
+                        time.time() - start))
+                results = benchmark_digests()
+                raise Rollback()
+        except Rollback:
+            pass
+
+        self.stdout.write('%-12s %10s %8s %8s' % (
+            'digest', 'seconds', 'queries', 'emails'))
+        for result in results:
+            self.stdout.write(
+                '%(digest)-12s %(seconds)10.3f %(queries)8d %(emails)8d' % (
+                    result))
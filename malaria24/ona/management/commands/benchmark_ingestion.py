@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from malaria24.ona.benchmarks import benchmark_ingestion
+from malaria24.ona.models import Facility
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Times importing synthetic submissions from a local fake Ona '
+            'server. Everything is rolled back and no alerts are sent.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=10000)
+        parser.add_argument('--forms', type=int, default=1)
+        parser.add_argument('--page-size', type=int, default=None)
+        parser.add_argument('--trace-memory', action='store_true',
+                            help='Also measure the peak memory, which '
+                                 'makes the import several times slower.')
+
+    def handle(self, *args, **options):
+        facility_codes = list(Facility.objects.values_list(
+            'facility_code', flat=True)[:1000])
+        try:
+            with override_settings(
+                    EMAIL_BACKEND=(
+                        'django.core.mail.backends.locmem.EmailBackend')), \
+                    transaction.atomic():
+                result = benchmark_ingestion(
+                    submissions=options['submissions'],
+                    forms=options['forms'],
+                    page_size=options['page_size'],
+                    facility_codes=facility_codes or None,
+                    trace_memory=options['trace_memory'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+        self.stdout.write(
+            'Imported %(submissions)s submissions in %(seconds).2f seconds.'
+            % result)
+        self.stdout.write(
+            'Submissions per second: %(submissions_per_second).1f' % result)
+        self.stdout.write(
+            'Queries per submission: %(queries_per_submission).2f' % result)
+        if 'peak_memory' in result:
+            self.stdout.write('Peak memory: %.1f MB' % (
+                result['peak_memory'] / 1024.0 / 1024.0,))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_cases(apps, schema_editor):
+    # Overlapping syncs could import the same submission more than once,
+    # keep the first copy of every submission.
+    ReportedCase = apps.get_model('ona', 'ReportedCase')
+    duplicates = (ReportedCase.objects.values('_uuid')
+                  .annotate(count=Count('pk'), first_pk=Min('pk'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        ReportedCase.objects.filter(_uuid=duplicate['_uuid']).exclude(
+            pk=duplicate['first_pk']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0029_onaform_sync_checkpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_cases, migrations.RunPython.noop),
+    ]
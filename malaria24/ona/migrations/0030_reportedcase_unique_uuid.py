@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0030_remove_duplicate_cases'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reportedcase',
+            name='_uuid',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0030_reportedcase_unique_uuid'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='facility',
+            name='facility_code',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.db import migrations, models
+
+
+def parse_date_of_birth(date_of_birth):
+    for date_format in ('%Y-%m-%d', '%y%m%d'):
+        try:
+            return datetime.strptime(date_of_birth, date_format).date()
+        except (TypeError, ValueError):
+            pass
+
+
+def backfill_birth_date(apps, schema_editor):
+    ReportedCase = apps.get_model('ona', 'ReportedCase')
+    cases = []
+    for case in ReportedCase.objects.only('pk', 'date_of_birth').iterator():
+        case.birth_date = parse_date_of_birth(case.date_of_birth)
+        cases.append(case)
+        if len(cases) == 1000:
+            ReportedCase.objects.bulk_update(cases, ['birth_date'])
+            cases = []
+    ReportedCase.objects.bulk_update(cases, ['birth_date'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0031_facility_facility_code_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportedcase',
+            name='birth_date',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(
+            backfill_birth_date, migrations.RunPython.noop),
+    ]
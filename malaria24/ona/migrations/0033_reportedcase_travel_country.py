@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+TRAVEL_COUNTRIES = [
+    'Somalia', 'Ethiopia', 'Mozambique', 'Zambia', 'Zimbabwe',
+]
+
+
+def parse_travel_country(abroad):
+    abroad = (abroad or '').strip()
+    for country in TRAVEL_COUNTRIES:
+        if country.lower() in abroad.lower():
+            return country
+    if 'no' in abroad.lower():
+        return 'No'
+    return abroad[:255].title()
+
+
+def backfill_travel_country(apps, schema_editor):
+    ReportedCase = apps.get_model('ona', 'ReportedCase')
+    cases = []
+    for case in ReportedCase.objects.only('pk', 'abroad').iterator():
+        case.travel_country = parse_travel_country(case.abroad)
+        cases.append(case)
+        if len(cases) == 1000:
+            ReportedCase.objects.bulk_update(cases, ['travel_country'])
+            cases = []
+    ReportedCase.objects.bulk_update(cases, ['travel_country'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0032_reportedcase_birth_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportedcase',
+            name='travel_country',
+            field=models.CharField(
+                blank=True, db_index=True, default='', max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RunPython(
+            backfill_travel_country, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import Counter
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_rollups(apps, schema_editor):
+    ReportedCase = apps.get_model('ona', 'ReportedCase')
+    Facility = apps.get_model('ona', 'Facility')
+    DailyCaseRollup = apps.get_model('ona', 'DailyCaseRollup')
+
+    facilities = {}
+    for facility_code, district, province in Facility.objects.values_list(
+            'facility_code', 'district', 'province').order_by('-pk'):
+        facilities[facility_code] = (district or '', province or '')
+
+    rollups = Counter()
+    for (facility_code, create_date_time, birth_date, gender,
+         travel_country) in ReportedCase.objects.values_list(
+            'facility_code', 'create_date_time', 'birth_date', 'gender',
+            'travel_country').iterator():
+        date = timezone.localtime(create_date_time).date()
+        district, province = facilities.get(facility_code, ('', ''))
+        if birth_date and birth_date <= date - timedelta(days=5 * 365):
+            age_band = 'over5'
+        else:
+            age_band = 'under5'
+        rollups[(
+            date, facility_code, district, province,
+            'female' if 'f' in gender.lower() else 'male',
+            age_band, travel_country)] += 1
+
+    DailyCaseRollup.objects.bulk_create([
+        DailyCaseRollup(
+            date=date, facility_code=facility_code, district=district,
+            province=province, gender=gender, age_band=age_band,
+            travel_country=travel_country, cases=cases)
+        for (date, facility_code, district, province, gender, age_band,
+             travel_country), cases in rollups.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0033_reportedcase_travel_country'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyCaseRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('facility_code', models.CharField(max_length=255)),
+                ('district', models.CharField(blank=True, max_length=255)),
+                ('province', models.CharField(blank=True, max_length=255)),
+                ('gender', models.CharField(choices=[('female', 'Female'), ('male', 'Male')], max_length=255)),
+                ('age_band', models.CharField(choices=[('under5', 'Under 5'), ('over5', 'Over 5')], max_length=255)),
+                ('travel_country', models.CharField(blank=True, max_length=255)),
+                ('cases', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('date', 'facility_code', 'district', 'province', 'gender', 'age_band', 'travel_country')},
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_email_content(apps, schema_editor):
+    Email = apps.get_model('ona', 'Email')
+    EmailContent = apps.get_model('ona', 'EmailContent')
+
+    content_ids = {}
+    emails = {}
+    for pk, html_content, pdf_content in Email.objects.values_list(
+            'pk', 'html_content', 'pdf_content').iterator():
+        content_hash = hashlib.sha256(
+            ('%s\0%s' % (html_content, pdf_content)).encode('utf-8')
+        ).hexdigest()
+        if content_hash not in content_ids:
+            content_ids[content_hash] = EmailContent.objects.create(
+                content_hash=content_hash, html_content=html_content,
+                pdf_content=pdf_content).pk
+        emails.setdefault(content_ids[content_hash], []).append(pk)
+
+    for content_id, pks in emails.items():
+        for i in range(0, len(pks), 500):
+            Email.objects.filter(pk__in=pks[i:i + 500]).update(
+                content_id=content_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0035_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('html_content', models.TextField()),
+                ('pdf_content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='content',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='ona.emailcontent'),
+        ),
+        migrations.RunPython(
+            backfill_email_content, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0036_emailcontent'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='email',
+            name='html_content',
+        ),
+        migrations.RemoveField(
+            model_name='email',
+            name='pdf_content',
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='content',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='ona.emailcontent'),
+        ),
+    ]
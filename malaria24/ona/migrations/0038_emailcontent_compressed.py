@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import malaria24.ona.models
+
+
+def compress_email_content(apps, schema_editor):
+    EmailContent = apps.get_model('ona', 'EmailContent')
+
+    batch = []
+    for content in EmailContent.objects.iterator(chunk_size=500):
+        content.compressed_html_content = content.html_content
+        content.compressed_pdf_content = content.pdf_content
+        batch.append(content)
+        if len(batch) == 500:
+            EmailContent.objects.bulk_update(batch, [
+                'compressed_html_content', 'compressed_pdf_content'])
+            batch = []
+    EmailContent.objects.bulk_update(batch, [
+        'compressed_html_content', 'compressed_pdf_content'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0037_remove_email_content_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailcontent',
+            name='compressed_html_content',
+            field=malaria24.ona.models.CompressedTextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='emailcontent',
+            name='compressed_pdf_content',
+            field=malaria24.ona.models.CompressedTextField(null=True),
+        ),
+        migrations.RunPython(
+            compress_email_content, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import malaria24.ona.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0038_emailcontent_compressed'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='emailcontent',
+            name='html_content',
+        ),
+        migrations.RemoveField(
+            model_name='emailcontent',
+            name='pdf_content',
+        ),
+        migrations.RenameField(
+            model_name='emailcontent',
+            old_name='compressed_html_content',
+            new_name='html_content',
+        ),
+        migrations.RenameField(
+            model_name='emailcontent',
+            old_name='compressed_pdf_content',
+            new_name='pdf_content',
+        ),
+        migrations.AlterField(
+            model_name='emailcontent',
+            name='html_content',
+            field=malaria24.ona.models.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='emailcontent',
+            name='pdf_content',
+            field=malaria24.ona.models.CompressedTextField(),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# TRAVEL_COUNTRIES and NO_INTERNATIONAL_TRAVEL when this was written
+TRAVEL_COUNTRIES = [
+    'Somalia', 'Ethiopia', 'Mozambique', 'Zambia', 'Zimbabwe', 'No']
+
+
+def merge_other_travel(apps, schema_editor):
+    DailyCaseRollup = apps.get_model('ona', 'DailyCaseRollup')
+    others = DailyCaseRollup.objects.exclude(
+        travel_country__in=TRAVEL_COUNTRIES + [''])
+    for row in others.values(
+            'date', 'facility_code', 'district', 'province', 'gender',
+            'age_band').annotate(total=models.Sum('cases')).order_by():
+        total = row.pop('total')
+        rollup, _ = DailyCaseRollup.objects.get_or_create(
+            travel_country='', defaults={'cases': 0}, **row)
+        DailyCaseRollup.objects.filter(pk=rollup.pk).update(
+            cases=models.F('cases') + total)
+    others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ona', '0042_onaformlisting'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            merge_other_travel, migrations.RunPython.noop),
+    ]
@@ -1,15 +1,20 @@
+import hashlib
 import logging
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
 from django.template.loader import render_to_string
 from django.utils import timezone
-from datetime import datetime
+from datetime import datetime, timedelta
 
-import pytz
 import re
+import threading
+import zlib
+from collections import Counter
 
 
 class Digest(models.Model):
@@ -70,32 +75,190 @@ class Digest(models.Model):
 
 class CalculationsMixin(object):
 
+    def get_over5_birth_date(self):
+        # Matches ReportedCase.age, which counts years as 365 days
+        return datetime.today().date() - timedelta(days=5 * 365)
+
     def calculate_over_under_5(self, qs):
-        over5 = len([x for x in qs if x.age >= 5])
-        under5 = qs.count() - over5
-        return (over5, under5)
+        counts = qs.aggregate(
+            cases=models.Count('pk'),
+            over5=models.Count('pk', filter=models.Q(
+                birth_date__lte=self.get_over5_birth_date())))
+        return (counts['over5'], counts['cases'] - counts['over5'])
 
     def calculate_male_female(self, qs):
         females = qs.filter(gender__icontains='f').count()
         males = qs.exclude(gender__icontains='f').count()
         return (females, males)
 
+    def get_travel_counts(self, qs):
+        return dict(
+            (row['travel_country'], row['cases'])
+            for row in qs.order_by().values('travel_country').annotate(
+                cases=models.Count('pk')))
+
     def calculate_travelhistory(self, qs):
-        somalia = qs.filter(abroad__icontains='Somalia').count()
-        ethiopia = qs.filter(abroad__icontains='Ethiopia').count()
-        mozambique = qs.filter(abroad__icontains='Mozambique').count()
-        zambia = qs.filter(abroad__icontains='Zambia').count()
-        zimbabwe = qs.filter(abroad__icontains='Zimbabwe').count()
-        c_list = [
-            'Zimbabwe', 'Somalia', 'Ethiopia', 'Mozambique',
-            'Zambia'
-        ]
-        other = qs.exclude(abroad__in=c_list).count()
-        return (somalia, ethiopia, mozambique, zambia, zimbabwe, other)
+        travel = self.get_travel_counts(qs)
+        countries = [travel.get(country, 0) for country in TRAVEL_COUNTRIES]
+        other = sum([
+            cases for country, cases in travel.items()
+            if country not in TRAVEL_COUNTRIES + [NO_INTERNATIONAL_TRAVEL]])
+        return tuple(countries + [other])
 
     def noInternationalTravel(self, qs):
-        noInternTravel = qs.filter(abroad__icontains='No').count()
-        return noInternTravel
+        return self.get_travel_counts(qs).get(NO_INTERNATIONAL_TRAVEL, 0)
+
+    def get_default_week(self):
+        date = datetime.today()
+        return 'Week ' + str(date.strftime("%U")) + ' ' + str(date.year)
+
+    def get_week(self, counts):
+        if not counts['cases']:
+            return self.get_default_week()
+        return "{0} to {1}".format(
+            counts['first'].strftime("%d %B %Y"),
+            counts['last'].strftime("%d %B %Y"))
+
+    def get_case_counts(self, qs):
+        """
+        Returns the counts for the cases in ``qs`` grouped by facility code,
+        computed with a conditional aggregation query and a query grouped
+        by travel country.
+        """
+        counts = {}
+        for row in qs.order_by().values('facility_code').annotate(
+                cases=models.Count('pk'),
+                females=models.Count(
+                    'pk', filter=models.Q(gender__icontains='f')),
+                over5=models.Count('pk', filter=models.Q(
+                    birth_date__lte=self.get_over5_birth_date())),
+                first=models.Min('create_date_time'),
+                last=models.Max('create_date_time')):
+            row['males'] = row['cases'] - row['females']
+            row['under5'] = row['cases'] - row['over5']
+            row['no_international_travel'] = 0
+            for country in TRAVEL_COUNTRIES:
+                row[country.lower()] = 0
+            row['other'] = row['cases']
+            counts[row.pop('facility_code')] = row
+
+        for row in qs.order_by().values(
+                'facility_code', 'travel_country').annotate(
+                    cases=models.Count('pk')):
+            facility_counts = counts[row['facility_code']]
+            if row['travel_country'] == NO_INTERNATIONAL_TRAVEL:
+                key = 'no_international_travel'
+            elif row['travel_country'] in TRAVEL_COUNTRIES:
+                key = row['travel_country'].lower()
+            else:
+                continue
+            facility_counts[key] += row['cases']
+            facility_counts['other'] -= row['cases']
+        return counts
+
+    def sum_case_counts(self, counts, facility_codes):
+        """
+        Adds up the ``counts`` for the given facility codes.
+        """
+        total = dict((key, 0) for key in CASE_COUNT_KEYS)
+        total['first'] = total['last'] = None
+        for facility_code in facility_codes:
+            row = counts.get(facility_code)
+            if row is None:
+                continue
+            for key in CASE_COUNT_KEYS:
+                total[key] += row[key]
+            total['first'] = min(total['first'] or row['first'], row['first'])
+            total['last'] = max(total['last'] or row['last'], row['last'])
+        return total
+
+    def get_totals(self, rows):
+        totals = dict(('total_%s' % (key,), sum([row[key] for row in rows]))
+                      for key in CASE_COUNT_KEYS)
+        totals['first'] = min(
+            [row['first'] for row in rows if row['first']], default=None)
+        totals['last'] = max(
+            [row['last'] for row in rows if row['last']], default=None)
+        return totals
+
+    def get_totals_week(self, totals):
+        return self.get_week({
+            'cases': totals['total_cases'],
+            'first': totals['first'],
+            'last': totals['last'],
+        })
+
+    def get_facility_districts(self):
+        """
+        Returns the districts for each province and the facility codes
+        for each district, from a single query.
+        """
+        provinces = {}
+        districts = {}
+        for province, district, facility_code in Facility.objects.values_list(
+                'province', 'district', 'facility_code'):
+            provinces.setdefault(province, set()).add(district)
+            districts.setdefault(district, set()).add(facility_code)
+        return provinces, districts
+
+    def sorted_districts(self, districts):
+        return sorted(districts, key=lambda district: (
+            district is None, district))
+
+    def get_undigested_case_counts(self):
+        return self.get_case_counts(
+            ReportedCase.objects.filter(digest__isnull=True))
+
+
+class ManagerDigestMixin(CalculationsMixin):
+    """
+    Sends a digest to each manager for their province or district,
+    as given by ``scope_field``.
+    """
+    scope_field = None
+    text_template = None
+    html_template = None
+
+    def get_manager_scope(self, scope, facility_code):
+        if scope:
+            return scope
+        return Facility.objects.filter(
+            facility_code=facility_code).values_list(
+                self.scope_field, flat=True).first()
+
+    def get_run_data(self):
+        """
+        Returns the keyword arguments for ``get_digest_email_data``
+        that can be shared by every report in a single digest run.
+        """
+        return {}
+
+    def send_digest_email(self):
+        run_data = self.get_run_data()
+        recipients = [actor.email_address for actor in self.recipients.all()]
+        # Managers sharing a province or district get the same report,
+        # so it is only computed and rendered once for each of them.
+        rendered = {}
+        for manager in self.get_managers():
+            scope = self.get_manager_scope(
+                getattr(manager, self.scope_field), manager.facility_code)
+            if not scope:
+                logging.warning('No %s or facility_code for %s.' % (
+                    self.scope_field, manager.name))
+                continue
+            if scope not in rendered:
+                context = self.get_digest_email_data(scope, None, **run_data)
+                rendered[scope] = (
+                    render_to_string(self.text_template, context),
+                    render_to_string(self.html_template, context))
+            text_content, html_content = rendered[scope]
+            send_mail(
+                subject='Digest of reported Malaria cases %s' % (
+                    timezone.now().strftime('%x'),),
+                message=text_content,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                recipient_list=set([manager.email_address] + recipients),
+                html_message=html_content)
 
 
 class NationalDigest(models.Model, CalculationsMixin):
@@ -116,124 +279,26 @@ class NationalDigest(models.Model, CalculationsMixin):
         return digest
 
     def get_digest_email_data(self):
-        utc = pytz.UTC
-        date = datetime.today()
-        week = 'Week ' + str(date.strftime("%U")) + ' ' + str(date.year)
-        provinces = []
-        total_cases = total_females = total_males = 0
-        total_under5 = total_over5 = 0
-        total_somalia = total_ethiopia = total_no_international_travel = \
-            total_mozambique = total_zambia = total_zimbabwe = 0
-        total_other = 0
-
-        all_case_ids = []
+        counts = self.get_undigested_case_counts()
+        province_districts, district_codes = self.get_facility_districts()
 
+        provinces = []
         for p, p_name in PROVINCES:
-            districts = (Facility.objects.filter(province=p).values_list(
-                'district', flat=True).distinct().order_by("district"))
-            for district in districts:
-                min_date = datetime.max.replace(tzinfo=utc)
-                max_date = datetime(1991, 1, 1, 0, 0,
-                                    0, 0, pytz.timezone('US/Pacific'))
-                district_fac_codes = Facility.objects.filter(
-                    district=district).values_list(
-                    'facility_code',
-                    flat=True).distinct().order_by("district")
-                province_cases = ReportedCase.objects.filter(
-                    facility_code__in=district_fac_codes, digest__isnull=True)
-
-                total_cases += province_cases.count()
-                all_case_ids += province_cases.values_list('pk', flat=True)
-
-                female, male = self.calculate_male_female(province_cases)
-                total_females += female
-                total_males += male
-
-                over5, under5 = self.calculate_over_under_5(province_cases)
-                somalia, ethiopia, mozambique, zambia, zimbabwe, other = \
-                    self.calculate_travelhistory(province_cases)
-                no_international_travel = \
-                    self.noInternationalTravel(province_cases)
-
-                total_over5 += over5
-                total_under5 += under5
-
-                total_somalia += somalia
-                total_ethiopia += ethiopia
-                total_mozambique += mozambique
-                total_zambia += zambia
-                total_zimbabwe += zimbabwe
-                total_other += other
-                total_no_international_travel += no_international_travel
-
-                if province_cases:
-                    start_date = province_cases \
-                        .first().create_date_time
-                    if start_date < min_date:
-                        min_date = start_date
-
-                    end_date = province_cases \
-                        .last().create_date_time
-                    if end_date > max_date:
-                        max_date = end_date
-                    week = "{0} to {1}".format(min_date.strftime(
-                        "%d %B %Y"
-                    ), max_date.strftime(
-                        "%d %B %Y"
-                    ))
-
-                provinces.append({
+            for district in self.sorted_districts(
+                    province_districts.get(p, [])):
+                row = self.sum_case_counts(counts, district_codes[district])
+                row.update({
                     'province': p_name,
                     'district': district,
-                    'cases': province_cases.count(),
-                    'females': female, 'males': male,
-                    'under5': under5,
-                    'over5': over5,
-                    'no_international_travel': no_international_travel,
-                    'week': week,
-                    'somalia': somalia,
-                    'ethiopia': ethiopia,
-                    'mozambique': mozambique,
-                    'zambia': zambia,
-                    'zimbabwe': zimbabwe,
-                    'other': other
+                    'week': self.get_week(row),
                 })
-        all_cases = ReportedCase.objects.filter(
-            pk__in=all_case_ids).order_by('create_date_time')
-        if all_cases.exists():
-            min_week = all_cases.first().create_date_time
-            max_week = all_cases.last().create_date_time
-
-            week = "{0} to {1}".format(min_week.strftime(
-                "%d %B %Y"
-            ), max_week.strftime(
-                "%d %B %Y"
-            ))
-        else:
-            date = datetime.today()
-            week = 'Week ' + str(
-                date.strftime("%U")) + ' ' + str(date.year)
-
-        totals = {}
-        totals['total_cases'] = total_cases
-        totals['total_females'] = total_females
-        totals['total_males'] = total_males
-        totals['total_under5'] = total_under5
-        totals['total_over5'] = total_over5
-
-        totals['total_no_international_travel'] = \
-            total_no_international_travel
-        totals['total_somalia'] = total_somalia
-        totals['total_ethiopia'] = total_ethiopia
-        totals['total_mozambique'] = total_mozambique
-        totals['total_zambia'] = total_zambia
-        totals['total_zimbabwe'] = total_zimbabwe
-        totals['total_other'] = total_other
+                provinces.append(row)
 
+        totals = self.get_totals(provinces)
         return {
             'digest': self,
             'provinces': provinces,
-            'week': week,
+            'week': self.get_totals_week(totals),
             'totals': totals
         }
 
@@ -254,13 +319,17 @@ class NationalDigest(models.Model, CalculationsMixin):
             html_message=html_content)
 
 
-class ProvincialDigest(models.Model, CalculationsMixin):
+class ProvincialDigest(models.Model, ManagerDigestMixin):
     """
     A Provincial Digest of reported cases.
     """
     created_at = models.DateTimeField(auto_now_add=True)
     recipients = models.ManyToManyField('Actor')
 
+    scope_field = 'province'
+    text_template = 'ona/text_provincial_digest.txt'
+    html_template = 'ona/html_provincial_digest.html'
+
     @classmethod
     def compile_digest(cls):
         recipients = Actor.objects.filter(
@@ -271,164 +340,55 @@ class ProvincialDigest(models.Model, CalculationsMixin):
         digest.save()
         return digest
 
-    def get_digest_email_data(self, province, facility_code):
-        utc = pytz.UTC
-        date2 = datetime.today()
-        week = 'Week ' + str(date2.strftime("%U")) + ' ' + str(date2.year)
-        district_list = []
-        all_case_ids = []
+    def get_managers(self):
+        return Actor.objects.provincial()
+
+    def get_run_data(self):
+        return {
+            'counts': self.get_undigested_case_counts(),
+            'facility_districts': self.get_facility_districts(),
+        }
+
+    def get_digest_email_data(self, province, facility_code, counts=None,
+                              facility_districts=None):
+        province = self.get_manager_scope(province, facility_code)
         if not province:
-            try:
-                province = Facility.objects.get(
-                    facility_code=facility_code).province
-            except Facility.DoesNotExist:
-                return {}
-        districts = (Facility.objects.filter(province=province).values_list(
-            'district', flat=True).distinct()
-            .order_by("district"))
-        total_cases = total_females = total_males = 0
-        total_under5 = total_over5 = 0
-        total_somalia = total_ethiopia = total_no_international_travel = \
-            total_mozambique = total_zambia = total_zimbabwe = 0
-        total_other = 0
-
-        for district in districts:
-            min_date = datetime.max.replace(tzinfo=utc)
-            max_date = datetime(1991, 1, 1, 0, 0,
-                                0, 0, pytz.timezone('US/Pacific'))
-            district_fac_codes = Facility.objects.filter(
-                district=district).values_list(
-                    'facility_code',
-                    flat=True).distinct().order_by("district")
-            district_cases = ReportedCase.objects.filter(
-                facility_code__in=district_fac_codes, digest__isnull=True)
-
-            total_cases += district_cases.count()
-            all_case_ids += district_cases.values_list('pk', flat=True)
-
-            female, male = self.calculate_male_female(district_cases)
-            total_females += female
-            total_males += male
-
-            over5, under5 = self.calculate_over_under_5(district_cases)
-            somalia, ethiopia, mozambique, zambia, zimbabwe, other = \
-                self.calculate_travelhistory(district_cases)
-            no_international_travel = \
-                self.noInternationalTravel(district_cases)
-
-            total_over5 += over5
-            total_under5 += under5
-
-            total_somalia += somalia
-            total_ethiopia += ethiopia
-            total_mozambique += mozambique
-            total_zambia += zambia
-            total_zimbabwe += zimbabwe
-            total_other += other
-            total_no_international_travel += no_international_travel
-
-            if district_cases:
-                start_date = district_cases \
-                    .first().create_date_time
-                if start_date < min_date:
-                    min_date = start_date
-
-                end_date = district_cases \
-                    .last().create_date_time
-                if end_date > max_date:
-                    max_date = end_date
-                week = "{0} to {1}".format(min_date.strftime(
-                    "%d %B %Y"
-                ), max_date.strftime(
-                    "%d %B %Y"
-                ))
+            return {}
+        if counts is None:
+            counts = self.get_undigested_case_counts()
+        province_districts, district_codes = (
+            facility_districts or self.get_facility_districts())
 
-            district_list.append({
+        district_list = []
+        for district in self.sorted_districts(
+                province_districts.get(province, [])):
+            row = self.sum_case_counts(counts, district_codes[district])
+            row.update({
                 'district': district,
-                'cases': district_cases.count(),
-                'females': female, 'males': male,
-                'under5': under5,
-                'over5': over5,
-                'week': week,
-                'no_international_travel': no_international_travel,
-                'somalia': somalia,
-                'ethiopia': ethiopia,
-                'mozambique': mozambique,
-                'zambia': zambia,
-                'zimbabwe': zimbabwe,
-                'other': other
+                'week': self.get_week(row),
             })
+            district_list.append(row)
 
-        all_cases = ReportedCase.objects.filter(
-            pk__in=all_case_ids).order_by('create_date_time')
-        if all_cases.exists():
-            min_week = all_cases.first().create_date_time
-            max_week = all_cases.last().create_date_time
-
-            week = "{0} to {1}".format(min_week.strftime(
-                "%d %B %Y"
-            ), max_week.strftime(
-                "%d %B %Y"
-            ))
-        else:
-            date = datetime.today()
-            week = 'Week ' + str(
-                date.strftime("%U")) + ' ' + str(date.year)
-
-        totals = {}
-        totals['total_cases'] = total_cases
-        totals['total_females'] = total_females
-        totals['total_males'] = total_males
-        totals['total_under5'] = total_under5
-        totals['total_over5'] = total_over5
-
-        totals['total_no_international_travel'] = \
-            total_no_international_travel
-        totals['total_somalia'] = total_somalia
-        totals['total_ethiopia'] = total_ethiopia
-        totals['total_mozambique'] = total_mozambique
-        totals['total_zambia'] = total_zambia
-        totals['total_zimbabwe'] = total_zimbabwe
-        totals['total_other'] = total_other
-
+        totals = self.get_totals(district_list)
         return {
             'digest': self,
             'districts': district_list,
-            'week': week,
+            'week': self.get_totals_week(totals),
             'totals': totals,
         }
 
-    def send_digest_email(self):
-        for manager in Actor.objects.provincial():
-            context = self.get_digest_email_data(
-                manager.province, manager.facility_code)
-            if not context:
-                logging.warning(
-                    'No province or facility_code for %s.' % manager.name)
-                continue
-            text_content = render_to_string(
-                'ona/text_provincial_digest.txt', context)
-            html_content = render_to_string(
-                'ona/html_provincial_digest.html', context)
-            mailing_list = set([
-                manager.email_address
-            ] + [actor.email_address for actor in self.recipients.all()])
-            send_mail(
-                subject='Digest of reported Malaria cases %s' % (
-                    timezone.now().strftime('%x'),),
-                message=text_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=mailing_list,
-                html_message=html_content)
-
 
-class DistrictDigest(models.Model, CalculationsMixin):
+class DistrictDigest(models.Model, ManagerDigestMixin):
     """
     A District Digest of reported cases.
     """
     created_at = models.DateTimeField(auto_now_add=True)
     recipients = models.ManyToManyField('Actor')
 
+    scope_field = 'district'
+    text_template = 'ona/text_district_digest.txt'
+    html_template = 'ona/html_district_digest.html'
+
     @classmethod
     def compile_digest(cls):
         recipients = Actor.objects.filter(
@@ -439,177 +399,59 @@ class DistrictDigest(models.Model, CalculationsMixin):
         digest.save()
         return digest
 
-    def get_digest_email_data(self, district, facility_code):
-        utc = pytz.UTC
-        date3 = datetime.today()
-        week = 'Week ' + str(date3.strftime("%U")) + ' ' + str(date3.year)
-        if not district:
-            try:
-                district = Facility.objects.get(
-                    facility_code=facility_code).district
-            except Facility.DoesNotExist:
-                return {}
-
-        district_fac_codes = Facility.objects.filter(
-            district=district).values_list(
-                'facility_code',
-                flat=True).distinct().order_by("district")
+    def get_managers(self):
+        return Actor.objects.district()
+
+    def get_district_facilities(self, **filters):
+        """
+        Returns the facility codes and names for each district.
+        """
+        district_facilities = {}
+        for district, facility_code, facility_name in (
+                Facility.objects.filter(**filters).order_by('pk').values_list(
+                    'district', 'facility_code', 'facility_name')):
+            district_facilities.setdefault(district, []).append(
+                (facility_code, facility_name))
+        return district_facilities
+
+    def get_run_data(self):
+        return {
+            'counts': self.get_undigested_case_counts(),
+            'district_facilities': self.get_district_facilities(),
+        }
 
-        district_cases = ReportedCase.objects.filter(
-            facility_code__in=district_fac_codes, digest__isnull=True)
+    def get_digest_email_data(self, district, facility_code, counts=None,
+                              district_facilities=None):
+        district = self.get_manager_scope(district, facility_code)
+        if not district:
+            return {}
+        if district_facilities is None:
+            district_facilities = self.get_district_facilities(
+                district=district)
+        facilities = district_facilities.get(district, [])
+        if counts is None:
+            counts = self.get_case_counts(ReportedCase.objects.filter(
+                facility_code__in=set(code for code, _ in facilities),
+                digest__isnull=True))
 
-        facilities = Facility.objects.filter(district=district)
         fac_list = []
-        all_case_ids = []
-        total_cases = total_females = total_males = 0
-        total_under5 = total_over5 = 0
-
-        total_somalia = total_ethiopia = total_no_international_travel = \
-            total_mozambique = total_zambia = total_zimbabwe = 0
-        total_other = 0
-
-        if district_cases:
-            start_date = district_cases.first().create_date_time.strftime(
-                "%d %B %Y"
-            )
-            end_date = district_cases.last().create_date_time.strftime(
-                "%d %B %Y"
-            )
-
-            week = "{0} to {1}".format(start_date, end_date)
-
-        for fac in facilities:
-            min_date = datetime.max.replace(tzinfo=utc)
-            max_date = datetime(1991, 1, 1, 0, 0,
-                                0, 0, pytz.timezone('US/Pacific'))
-            facility_name = 'Unknown (district: %s)' % (district,)
-            if fac:
-                facility_name = fac.facility_name
-
-            district_name = 'Unknown district'
-            if fac.district:
-                district_name = fac.district
-
-            fac_cases = district_cases.filter(facility_code=fac.facility_code)
-            total_cases += fac_cases.count()
-            all_case_ids += district_cases.values_list('pk', flat=True)
-
-            female, male = self.calculate_male_female(fac_cases)
-            total_females += female
-            total_males += male
-
-            over5, under5 = self.calculate_over_under_5(fac_cases)
-
-            somalia, ethiopia, mozambique, zambia, zimbabwe, other = \
-                self.calculate_travelhistory(fac_cases)
-            no_international_travel = \
-                self.noInternationalTravel(fac_cases)
-
-            total_over5 += over5
-            total_under5 += under5
-
-            total_somalia += somalia
-            total_ethiopia += ethiopia
-            total_mozambique += mozambique
-            total_zambia += zambia
-            total_zimbabwe += zimbabwe
-            total_other += other
-            total_no_international_travel += no_international_travel
-
-            if fac_cases:
-                start_date = fac_cases \
-                    .first().create_date_time
-                if start_date < min_date:
-                    min_date = start_date
-
-                end_date = fac_cases \
-                    .last().create_date_time
-                if end_date > max_date:
-                    max_date = end_date
-                week = "{0} to {1}".format(min_date.strftime(
-                    "%d %B %Y"
-                ), max_date.strftime(
-                    "%d %B %Y"
-                ))
-
-            fac_list.append({
+        for code, facility_name in facilities:
+            row = self.sum_case_counts(counts, [code])
+            row.update({
                 'facility': facility_name,
-                'district': district_name,
-                'cases': fac_cases.count(),
-                'females': female, 'males': male,
-                'under5': under5,
-                'over5': over5,
-                'week': week,
-                'no_international_travel': no_international_travel,
-                'somalia': somalia,
-                'ethiopia': ethiopia,
-                'mozambique': mozambique,
-                'zambia': zambia,
-                'zimbabwe': zimbabwe,
-                'other': other
+                'district': district,
+                'week': self.get_week(row),
             })
-        all_cases = ReportedCase.objects.filter(
-            pk__in=all_case_ids).order_by('create_date_time')
-        if all_cases.exists():
-            min_week = all_cases.first().create_date_time
-            max_week = all_cases.last().create_date_time
-
-            week = "{0} to {1}".format(min_week.strftime(
-                "%d %B %Y"
-            ), max_week.strftime(
-                "%d %B %Y"
-            ))
-        else:
-            date = datetime.today()
-            week = 'Week ' + str(
-                date.strftime("%U")) + ' ' + str(date.year)
-
-        totals = {}
-        totals['total_cases'] = total_cases
-        totals['total_females'] = total_females
-        totals['total_males'] = total_males
-        totals['total_under5'] = total_under5
-        totals['total_over5'] = total_over5
-
-        totals['total_no_international_travel'] = \
-            total_no_international_travel
-        totals['total_somalia'] = total_somalia
-        totals['total_ethiopia'] = total_ethiopia
-        totals['total_mozambique'] = total_mozambique
-        totals['total_zambia'] = total_zambia
-        totals['total_zimbabwe'] = total_zimbabwe
-        totals['total_other'] = total_other
+            fac_list.append(row)
 
+        totals = self.get_totals(fac_list)
         return {
             'digest': self,
             'facility': fac_list,
-            'week': week,
+            'week': self.get_totals_week(totals),
             'totals': totals
         }
 
-    def send_digest_email(self):
-        for manager in Actor.objects.district():
-            context = self.get_digest_email_data(
-                manager.district, manager.facility_code)
-            if not context:
-                logging.warning(
-                    'No district or facility_code for %s.' % manager.name)
-                continue
-            text_content = render_to_string(
-                'ona/text_district_digest.txt', context)
-            html_content = render_to_string(
-                'ona/html_district_digest.html', context)
-            mailing_list = set([
-                manager.email_address
-            ] + [actor.email_address for actor in self.recipients.all()])
-            send_mail(
-                subject='Digest of reported Malaria cases %s' % (
-                    timezone.now().strftime('%x'),),
-                message=text_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=mailing_list,
-                html_message=html_content)
-
 
 class OnaForm(models.Model):
     uuid = models.CharField(max_length=255)
@@ -617,12 +459,42 @@ class OnaForm(models.Model):
     id_string = models.CharField(max_length=255, null=True)
     title = models.CharField(max_length=255, null=True)
     active = models.BooleanField(default=False)
+    last_submission_id = models.BigIntegerField(null=True, blank=True)
+    last_synced_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __unicode__(self):
         return self.title
 
+    def update_checkpoint(self, submission_id):
+        '''
+        Advance the sync checkpoint, it never moves backwards. The check
+        is done by the database, so an overlapping sync that has only got
+        as far as an older submission can't undo a newer checkpoint.
+        '''
+        forms = OnaForm.objects.filter(pk=self.pk)
+        if submission_id is not None:
+            behind = Q(last_submission_id__lt=submission_id)
+            if forms.filter(behind | Q(last_submission_id__isnull=True)).update(
+                    last_submission_id=submission_id):
+                self.last_submission_id = submission_id
+            else:
+                self.refresh_from_db(fields=['last_submission_id'])
+        self.last_synced_at = timezone.now()
+        forms.update(last_synced_at=self.last_synced_at)
+
+
+class OnaFormListing(models.Model):
+    '''
+    The ETag and Last-Modified of the last forms listing fetched from Ona,
+    shared by all the workers. It is cleared whenever a form changes
+    here, so the next fetch gets the full listing again.
+    '''
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=255, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
 
 class ReportedCase(models.Model):
     """
@@ -633,6 +505,9 @@ class ReportedCase(models.Model):
     last_name = models.CharField(max_length=255)
     locality = models.CharField(max_length=255)
     date_of_birth = models.CharField(max_length=255)
+    birth_date = models.DateField(null=True, blank=True, db_index=True)
+    travel_country = models.CharField(
+        max_length=255, blank=True, db_index=True)
     create_date_time = models.DateTimeField()
     sa_id_number = models.CharField(max_length=255, null=True)
     msisdn = models.CharField(max_length=255)
@@ -647,7 +522,7 @@ class ReportedCase(models.Model):
     case_number = models.CharField(
         max_length=255, null=True, blank=True)
     _id = models.CharField(max_length=255)
-    _uuid = models.CharField(max_length=255)
+    _uuid = models.CharField(max_length=255, unique=True)
     _xform_id_string = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -676,6 +551,48 @@ class ReportedCase(models.Model):
         except ValueError:
             return mobile_number.lower()  # convert to lower case
 
+    def save(self, *args, **kwargs):
+        self.normalize()
+        return super(ReportedCase, self).save(*args, **kwargs)
+
+    def normalize(self):
+        "Sets the fields that are parsed from the free text ones"
+        self.birth_date = self.get_birth_date()
+        self.travel_country = self.parse_travel_country(self.abroad)
+
+    @staticmethod
+    def parse_travel_country(abroad):
+        """
+        Returns the country travelled to for the free text ``abroad``,
+        one of TRAVEL_COUNTRIES, NO_INTERNATIONAL_TRAVEL or otherwise
+        the text itself, tidied up.
+        """
+        abroad = (abroad or '').strip()
+        for country in TRAVEL_COUNTRIES:
+            if country.lower() in abroad.lower():
+                return country
+        if 'no' in abroad.lower():
+            return NO_INTERNATIONAL_TRAVEL
+        return abroad[:255].title()
+
+    @staticmethod
+    def parse_date_of_birth(date_of_birth):
+        try:
+            return datetime.strptime(date_of_birth, '%Y-%m-%d')
+        except ValueError:
+            # NOTE: This is an unfortunate side-effect of changing how
+            #       date of birth is stored mid-way the data.
+            #       There is historical data in Ona that has this
+            #       old format.
+            return datetime.strptime(date_of_birth, '%y%m%d')
+
+    def get_birth_date(self):
+        "Returns date_of_birth as a date, or None if it can't be parsed"
+        try:
+            return self.parse_date_of_birth(self.date_of_birth).date()
+        except (TypeError, ValueError):
+            return None
+
     def get_data(self):
         '''JSON Formats need create_date_time & date_of_birth
         to be overridden
@@ -684,14 +601,7 @@ class ReportedCase(models.Model):
         correct format
         if sa_id_number is None, needs to return empty string'''
 
-        try:
-            birth_date = datetime.strptime(self.date_of_birth, '%Y-%m-%d')
-        except ValueError:
-            # NOTE: This is an unfortunate side-effect of changing how
-            #       date of birth is stored mid-way the data.
-            #       There is historical data in Ona that has this
-            #       old format.
-            birth_date = datetime.strptime(self.date_of_birth, '%y%m%d')
+        birth_date = self.parse_date_of_birth(self.date_of_birth)
 
         reported_by = self.normalize_msisdn(self.reported_by)
         msisdn = self.normalize_msisdn(self.msisdn)
@@ -751,14 +661,7 @@ class ReportedCase(models.Model):
     def age(self):
         "Returns the age of the patient"
         today = self.get_today()
-        try:
-            dob = datetime.strptime(self.date_of_birth, '%Y-%m-%d')
-        except ValueError:
-            # NOTE: This is an unfortunate side-effect of changing how
-            #       date of birth is stored mid-way the data.
-            #       There is historical data in Ona that has this
-            #       old format.
-            dob = datetime.strptime(self.date_of_birth, '%y%m%d')
+        dob = self.parse_date_of_birth(self.date_of_birth)
         return int((today - dob).days / 365)
 
     def get_ehps(self):
@@ -792,6 +695,18 @@ MANAGER_PROVINCIAL = 'MANAGER_PROVINCIAL'
 MANAGER_NATIONAL = 'MANAGER_NATIONAL'
 MIS = 'MIS'
 
+NO_INTERNATIONAL_TRAVEL = 'No'
+
+TRAVEL_COUNTRIES = [
+    'Somalia', 'Ethiopia', 'Mozambique', 'Zambia', 'Zimbabwe',
+]
+
+CASE_COUNT_KEYS = (
+    'cases', 'females', 'males', 'under5', 'over5',
+    'no_international_travel', 'somalia', 'ethiopia', 'mozambique',
+    'zambia', 'zimbabwe', 'other',
+)
+
 PROVINCES = [
     ('The Eastern Cape', 'The Eastern Cape'),
     ('The Free State', 'The Free State'),
@@ -845,19 +760,96 @@ class SMS(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
 
+class CompressedTextField(models.BinaryField):
+    """
+    Text that is stored zlib compressed.
+    """
+
+    def get_prep_value(self, value):
+        value = super(CompressedTextField, self).get_prep_value(value)
+        if value is None:
+            return None
+        return zlib.compress(value.encode('utf-8'))
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return zlib.decompress(bytes(value)).decode('utf-8')
+
+    def to_python(self, value):
+        return value
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+
+class EmailContent(models.Model):
+    """
+    The content of a sent Email, stored once however many emails it was
+    sent in. Load it with ``defer()`` or ``only()`` where the content
+    itself isn't needed, it's only decompressed when accessed then.
+    """
+    content_hash = models.CharField(max_length=64, unique=True)
+    html_content = CompressedTextField()
+    pdf_content = CompressedTextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def get_hash(html_content, pdf_content):
+        return hashlib.sha256(
+            ('%s\0%s' % (html_content, pdf_content)).encode('utf-8')
+        ).hexdigest()
+
+
+class EmailQuerySet(models.QuerySet):
+
+    def record(self, sent):
+        """
+        Records a list of ``(recipients, html_content, pdf_content)``
+        sent emails, an Email for each recipient, in three queries.
+        """
+        hashes = dict(
+            ((html_content, pdf_content),
+             EmailContent.get_hash(html_content, pdf_content))
+            for _, html_content, pdf_content in sent)
+        EmailContent.objects.bulk_create([
+            EmailContent(content_hash=content_hash,
+                         html_content=html_content,
+                         pdf_content=pdf_content)
+            for (html_content, pdf_content), content_hash in hashes.items()
+        ], ignore_conflicts=True)
+        content_ids = dict(EmailContent.objects.filter(
+            content_hash__in=hashes.values()).values_list(
+                'content_hash', 'pk'))
+        return self.bulk_create([
+            Email(to=to, content_id=content_ids[
+                hashes[(html_content, pdf_content)]])
+            for recipients, html_content, pdf_content in sent
+            for to in recipients])
+
+
 class Email(models.Model):
     """
     An Email sent from the system, for audit trail purposes.
     """
     to = models.CharField(max_length=255)
-    html_content = models.TextField()
-    pdf_content = models.TextField()
+    content = models.ForeignKey(EmailContent, on_delete=models.PROTECT)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = EmailQuerySet.as_manager()
+
+    @property
+    def html_content(self):
+        return self.content.html_content
+
+    @property
+    def pdf_content(self):
+        return self.content.pdf_content
+
 
 class Facility(models.Model):
-    facility_code = models.CharField(max_length=255)
+    facility_code = models.CharField(max_length=255, db_index=True)
     facility_name = models.CharField(max_length=255, null=True, blank=True)
     province = models.CharField(
         max_length=255, null=True, blank=True, choices=PROVINCES)
@@ -942,6 +934,229 @@ class SMSEvent(models.Model):
     )
 
 
+class OutboxMessage(models.Model):
+    """
+    A Celery task call written in the same transaction as the change
+    that caused it, and sent to the broker by ``dispatch_outbox`` once
+    that transaction has been committed.
+    """
+    task = models.CharField(max_length=255)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return '%s%r' % (self.task, tuple(self.args))
+
+    @classmethod
+    def call(cls, task, *args, **kwargs):
+        """
+        Returns an unsaved message for a call of ``task``, to be recorded
+        along with others by ``enqueue_all``.
+        """
+        return cls(task=task.name, args=args, kwargs=kwargs)
+
+    @classmethod
+    def enqueue(cls, task, *args, **kwargs):
+        """
+        Records a call of ``task`` and schedules a dispatch for when the
+        current transaction commits.
+        """
+        [message] = cls.enqueue_all([cls.call(task, *args, **kwargs)])
+        return message
+
+    @classmethod
+    def enqueue_all(cls, messages):
+        """
+        Records ``messages`` with a single insert and schedules a dispatch
+        for when the current transaction commits, only one dispatch is
+        sent for all the messages in a transaction.
+        """
+        if not messages:
+            return []
+        messages = cls.objects.bulk_create(messages)
+        _outbox.dispatch_pending = True
+        transaction.on_commit(schedule_outbox_dispatch)
+        return messages
+
+
+_outbox = threading.local()
+
+
+def schedule_outbox_dispatch():
+    from malaria24.ona.tasks import dispatch_outbox
+    # The first of the transaction's hooks sends the dispatch, the rest
+    # find nothing pending
+    if not getattr(_outbox, 'dispatch_pending', False):
+        return
+    _outbox.dispatch_pending = False
+    try:
+        dispatch_outbox.delay()
+    except Exception as e:
+        # The messages are safely stored, the periodic dispatch picks
+        # them up once the broker is back
+        logging.error('Unable to schedule an outbox dispatch: %s' % (e,))
+
+
+FEMALE = 'female'
+MALE = 'male'
+UNDER5 = 'under5'
+OVER5 = 'over5'
+
+
+class DailyCaseRollupQuerySet(models.QuerySet):
+
+    def totals(self, *fields):
+        """
+        Returns the number of cases grouped by ``fields``.
+        """
+        return (self.values(*fields).annotate(cases=models.Sum('cases'))
+                .order_by(*fields))
+
+
+class DailyCaseRollup(models.Model):
+    """
+    The number of cases reported per day and facility by gender, age band
+    and travel country, kept up to date as cases are created. The travel
+    country is one of TRAVEL_COUNTRIES or NO_INTERNATIONAL_TRAVEL, or
+    blank for anywhere else.
+    """
+    date = models.DateField()
+    facility_code = models.CharField(max_length=255)
+    district = models.CharField(max_length=255, blank=True)
+    province = models.CharField(max_length=255, blank=True)
+    gender = models.CharField(max_length=255, choices=[
+        (FEMALE, 'Female'),
+        (MALE, 'Male'),
+    ])
+    age_band = models.CharField(max_length=255, choices=[
+        (UNDER5, 'Under 5'),
+        (OVER5, 'Over 5'),
+    ])
+    travel_country = models.CharField(max_length=255, blank=True)
+    cases = models.PositiveIntegerField(default=0)
+
+    objects = DailyCaseRollupQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('date', 'facility_code', 'district', 'province',
+                           'gender', 'age_band', 'travel_country')
+
+    @classmethod
+    def get_key(cls, reported_case, facilities=None):
+        """
+        Returns the rollup fields for ``reported_case``. ``facilities``
+        maps facility codes to their district and province, the facility
+        is looked up if it isn't given. A case with a create_date_time
+        that can't be parsed is counted on the day it is imported.
+        """
+        create_date_time = reported_case.create_date_time
+        if isinstance(create_date_time, str):
+            # Parsed the way the field parses it when it is saved
+            try:
+                create_date_time = ReportedCase._meta.get_field(
+                    'create_date_time').to_python(create_date_time)
+            except ValidationError:
+                create_date_time = None
+        if create_date_time is None:
+            logging.warning(
+                'Unable to parse the create_date_time of case %s.' % (
+                    reported_case._uuid,))
+            create_date_time = timezone.now()
+        if timezone.is_naive(create_date_time):
+            create_date_time = timezone.make_aware(create_date_time)
+        date = timezone.localtime(create_date_time).date()
+        if facilities is None:
+            facilities = cls.get_facilities([reported_case])
+        district, province = facilities.get(
+            reported_case.facility_code, (None, None))
+        # Ages are banded as at the day the case was reported, using the
+        # same 365 day years as ReportedCase.age
+        birth_date = reported_case.birth_date
+        if birth_date and birth_date <= date - timedelta(days=5 * 365):
+            age_band = OVER5
+        else:
+            age_band = UNDER5
+        # The rest are free text, and only ever reported together as other
+        travel_country = reported_case.travel_country
+        if travel_country not in TRAVEL_COUNTRIES + [NO_INTERNATIONAL_TRAVEL]:
+            travel_country = ''
+        return {
+            'date': date,
+            'facility_code': reported_case.facility_code,
+            'district': district or '',
+            'province': province or '',
+            'gender': FEMALE if 'f' in reported_case.gender.lower() else MALE,
+            'age_band': age_band,
+            'travel_country': travel_country,
+        }
+
+    @staticmethod
+    def get_facilities(reported_cases):
+        """
+        Returns the district and province of the first facility with each
+        of the cases' facility codes.
+        """
+        facility_codes = set([case.facility_code for case in reported_cases])
+        facilities = {}
+        for facility_code, district, province in Facility.objects.filter(
+                facility_code__in=facility_codes).values_list(
+                    'facility_code', 'district', 'province').order_by('pk'):
+            facilities.setdefault(facility_code, (district, province))
+        return facilities
+
+    @classmethod
+    def add_case(cls, reported_case):
+        cls.add_cases([reported_case])
+
+    @classmethod
+    def add_cases(cls, reported_cases):
+        """
+        Counts ``reported_cases`` in their rollups, with one query each to
+        look up the facilities, create any missing rollups and find them,
+        and one update for each distinct number of cases added.
+        """
+        facilities = cls.get_facilities(reported_cases)
+        counts = Counter(
+            tuple(sorted(cls.get_key(case, facilities).items()))
+            for case in reported_cases)
+        if not counts:
+            return
+        cls.objects.bulk_create(
+            [cls(**dict(key)) for key in counts], ignore_conflicts=True)
+
+        fields = [field for field, _ in next(iter(counts))]
+        rollups = cls.objects.filter(
+            date__in=set([dict(key)['date'] for key in counts]),
+            facility_code__in=set([
+                dict(key)['facility_code'] for key in counts]),
+        ).values_list('pk', *fields)
+        increments = {}
+        for row in rollups:
+            count = counts.get(tuple(zip(fields, row[1:])))
+            if count:
+                increments.setdefault(count, []).append(row[0])
+        for count, pks in increments.items():
+            cls.objects.filter(pk__in=pks).update(
+                cases=models.F('cases') + count)
+
+
+def clear_ona_form_listing(sender, **kwargs):
+    OnaFormListing.objects.all().delete()
+
+
+def new_case_update_rollup(sender, instance, created, **kwargs):
+    # import_submissions counts the cases it imports in bulk
+    if not created or kwargs.get('bulk'):
+        return
+
+    DailyCaseRollup.add_case(instance)
+
+
 def new_case_alert_jembi(sender, instance, created, **kwargs):
     if not created:
         return
@@ -975,7 +1190,7 @@ def new_case_alert_mis(sender, instance, created, **kwargs):
 def alert_jembi(reported_case):
     from malaria24.ona.tasks import compile_and_send_jembi
 
-    compile_and_send_jembi.delay(reported_case.pk)
+    OutboxMessage.enqueue(compile_and_send_jembi, reported_case.pk)
 
 
 def alert_ehps(reported_case):
@@ -1002,13 +1217,17 @@ def alert_ehps(reported_case):
         'gender': reported_case.gender,
         'msisdn': reported_case.msisdn}
 
+    messages = []
     for ehp in ehps:
         reported_case.ehps.add(ehp)
         if ehp.phone_number and ehp.email_address:
-            send_sms.delay(to=ehp.phone_number, content=sms_copy)
-            send_case_email.delay(reported_case.pk, [ehp.email_address])
+            messages.append(OutboxMessage.call(
+                send_sms, to=ehp.phone_number, content=sms_copy))
+            messages.append(OutboxMessage.call(
+                send_case_email, reported_case.pk, [ehp.email_address]))
         elif ehp.phone_number:
-            send_sms.delay(to=ehp.phone_number, content=sms_copy)
+            messages.append(OutboxMessage.call(
+                send_sms, to=ehp.phone_number, content=sms_copy))
             logging.warning(
                 ('Unable to Email report for case %s to %s. '
                  'Missing email_address.') % (
@@ -1016,7 +1235,8 @@ def alert_ehps(reported_case):
                     ehp))
 
         elif ehp.email_address:
-            send_case_email.delay(reported_case.pk, [ehp.email_address])
+            messages.append(OutboxMessage.call(
+                send_case_email, reported_case.pk, [ehp.email_address]))
             logging.warning(
                 ('Unable to SMS report for case %s to %s. '
                  'Missing phone_number.') % (
@@ -1024,16 +1244,18 @@ def alert_ehps(reported_case):
                     ehp))
 
     if reported_case.reported_by:
-        send_sms.delay(to=reported_case.reported_by,
-                       content=('Your reported case for %s %s has been '
-                                'assigned case number %s.' % (
-                                    reported_case.first_name,
-                                    reported_case.last_name,
-                                    reported_case.case_number,)))
+        messages.append(OutboxMessage.call(
+            send_sms, to=reported_case.reported_by,
+            content=('Your reported case for %s %s has been '
+                     'assigned case number %s.' % (
+                         reported_case.first_name,
+                         reported_case.last_name,
+                         reported_case.case_number,))))
     else:
         logging.warning(
             ('Unable to SMS case number for case %s. '
              'Missing reported_by.') % (reported_case.case_number,))
+    OutboxMessage.enqueue_all(messages)
 
 
 def alert_case_investigators(reported_case):
@@ -1046,9 +1268,11 @@ def alert_case_investigators(reported_case):
             'No Case Investigators found for facility code %s.' % (
                 reported_case.facility_code,))
 
+    messages = []
     for case_investigator in case_investigators:
         if case_investigator.phone_number:
-            send_sms.delay(
+            messages.append(OutboxMessage.call(
+                send_sms,
                 to=case_investigator.phone_number,
                 content=(
                     'New Case: %(case_number)s '
@@ -1067,13 +1291,14 @@ def alert_case_investigators(reported_case):
                     'age': reported_case.age,
                     'gender': reported_case.gender,
                     'msisdn': reported_case.msisdn,
-                })
+                }))
         else:
             logging.warning(
                 ('Unable to SMS report for case %s to %s. '
                  'Missing phone_number.') % (
                     reported_case.case_number,
                     case_investigator))
+    OutboxMessage.enqueue_all(messages)
 
 
 def alert_case_mis(reported_case):
@@ -1089,18 +1314,23 @@ def alert_case_mis(reported_case):
             'No MIS found for facility code %s.' % (
                 reported_case.facility_code,))
 
+    messages = []
     for name, role, email in mis_set:
         if email:
-            send_case_email.delay(
-                reported_case.pk, [email])
+            messages.append(OutboxMessage.call(
+                send_case_email, reported_case.pk, [email]))
 
         else:
             logging.warning(
                 (f'Unable to Email report for case {reported_case.case_number} '
                  f'to {name} ({role}). Missing email_address.'))
+    OutboxMessage.enqueue_all(messages)
 
 
 post_save.connect(new_case_alert_ehps, sender=ReportedCase)
 post_save.connect(new_case_alert_case_investigators, sender=ReportedCase)
 post_save.connect(new_case_alert_mis, sender=ReportedCase)
 post_save.connect(new_case_alert_jembi, sender=ReportedCase)
+post_save.connect(new_case_update_rollup, sender=ReportedCase)
+post_save.connect(clear_ona_form_listing, sender=OnaForm)
+post_delete.connect(clear_ona_form_listing, sender=OnaForm)
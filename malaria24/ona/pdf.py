@@ -0,0 +1,176 @@
+"""
+Renders PDFs with wkhtmltopdf from a bounded pool of workers, piping
+the HTML in and the PDF out, optionally sharing one long-lived X display
+instead of starting an X server for every PDF.
+"""
+import atexit
+import ctypes
+import ctypes.util
+import os
+import signal
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from celery.signals import worker_process_init, worker_process_shutdown
+from django.conf import settings
+
+# From <sys/prctl.h>
+PR_SET_PDEATHSIG = 1
+
+
+class PDFRenderError(Exception):
+    pass
+
+
+def get_die_with_parent():
+    """
+    Returns a ``preexec_fn`` that has the Linux kernel terminate the child
+    process when the thread that started it exits, even if the parent is
+    killed or leaves through ``os._exit``. Returns None if that isn't
+    supported here, or if this isn't the main thread, whose exit is the
+    only one that means the process is going away.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return None
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    # Looked up before forking, the child only makes the call
+    prctl = getattr(ctypes.CDLL(libc_name), 'prctl', None)
+    if prctl is None:
+        return None
+
+    def die_with_parent():
+        prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    return die_with_parent
+
+
+class XvfbDisplay(object):
+    """
+    An Xvfb server on the first free display number, started once and
+    shared by every render. When it is started from the main thread it is
+    terminated if the process goes away without stopping it.
+    """
+
+    def __init__(self, command='Xvfb', screen='1024x768x24'):
+        self.command = command
+        self.screen = screen
+        self.process = None
+        self.display = None
+
+    def start(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                [self.command, '-displayfd', str(write_fd),
+                 '-screen', '0', self.screen, '-nolisten', 'tcp'],
+                pass_fds=[write_fd], preexec_fn=get_die_with_parent(),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            os.close(write_fd)
+        # Xvfb writes the display number once it is ready for clients
+        with os.fdopen(read_fd) as fp:
+            number = fp.readline().strip()
+        if not number:
+            self.stop()
+            raise PDFRenderError('Unable to start %s.' % (self.command,))
+        self.display = ':%s' % (number,)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+class PDFRenderPool(object):
+    """
+    Renders up to ``workers`` PDFs at once, the rest wait their turn.
+    """
+
+    def __init__(self, workers, command, timeout=None, xvfb=False):
+        self.workers = workers
+        self.command = list(command)
+        self.timeout = timeout
+        self.xvfb = XvfbDisplay() if xvfb else None
+        self.executor = None
+        self.env = None
+
+    def start(self):
+        self.env = dict(os.environ)
+        if self.xvfb:
+            self.xvfb.start()
+            self.env['DISPLAY'] = self.xvfb.display
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.xvfb:
+            self.xvfb.stop()
+
+    def render(self, html_content):
+        """
+        Returns the PDF for ``html_content`` as bytes.
+        """
+        return self.executor.submit(self.render_now, html_content).result()
+
+    def render_now(self, html_content):
+        try:
+            process = subprocess.run(
+                self.command + ['--quiet', '-', '-'],
+                input=html_content.encode('utf-8'),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=self.env, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise PDFRenderError('Timed out rendering PDF.')
+        # wkhtmltopdf exits with an error for some failed resources even
+        # though the PDF is fine, so go by the output instead
+        if not process.stdout.startswith(b'%PDF'):
+            raise PDFRenderError('Unable to render PDF: %s' % (
+                process.stderr.decode('utf-8', 'replace').strip(),))
+        return process.stdout
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pdf_pool():
+    """
+    Returns the render pool for this process, starting it on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = PDFRenderPool(
+                settings.PDF_RENDER_WORKERS, settings.PDF_RENDER_COMMAND,
+                timeout=settings.PDF_RENDER_TIMEOUT,
+                xvfb=settings.PDF_RENDER_XVFB)
+            pool.start()
+            atexit.register(pool.close)
+            _pool = pool
+        return _pool
+
+
+def start_pdf_pool(**kwargs):
+    get_pdf_pool()
+
+
+def close_pdf_pool(**kwargs):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            atexit.unregister(_pool.close)
+            _pool = None
+
+
+# Started from the main thread of each of Celery's pool processes, rather
+# than from whichever thread renders first, so that Xvfb is only stopped
+# when the process goes away
+worker_process_init.connect(start_pdf_pool)
+# Celery's pool processes leave through os._exit, which skips atexit
+worker_process_shutdown.connect(close_pdf_pool)
@@ -0,0 +1,154 @@
+"""
+Token bucket rate limiting, shared by all the workers through Redis or
+kept in the process when no Redis URL is configured.
+"""
+import threading
+import time
+
+import redis
+
+from django.conf import settings
+
+
+class LocalBucketStore(object):
+    """
+    Keeps the buckets and counters in memory, which limits each process
+    separately. Used in development and tests.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.counters = {}
+
+    def take(self, key, rate, capacity, now):
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            return wait
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            return self.counters[key]
+
+    def get(self, key):
+        return self.counters.get(key, 0)
+
+
+class RedisBucketStore(object):
+    """
+    Keeps the buckets and counters in Redis so the limits apply across
+    all the workers. A bucket is updated atomically by a Lua script.
+    """
+    TAKE_SCRIPT = """
+        local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+        local updated = tonumber(redis.call('HGET', KEYS[1], 'updated'))
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        if tokens == nil then
+            tokens = capacity
+            updated = now
+        end
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+        return tostring(wait)
+    """
+
+    def __init__(self, url):
+        self.redis = redis.StrictRedis.from_url(url)
+        self.take_script = self.redis.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key, rate, capacity, now):
+        return float(self.take_script(keys=[key], args=[rate, capacity, now]))
+
+    def incr(self, key, amount=1):
+        return self.redis.incrby(key, amount)
+
+    def get(self, key):
+        return int(self.redis.get(key) or 0)
+
+
+class RateLimiter(object):
+    """
+    Allows ``rate`` calls per second on average, with bursts of up to
+    ``capacity`` calls.
+    """
+
+    def __init__(self, name, rate, capacity, store):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.store = store
+
+    def key(self, suffix):
+        return 'ratelimit:%s:%s' % (self.name, suffix)
+
+    def acquire(self, max_wait=0):
+        """
+        Takes a token, waiting up to ``max_wait`` seconds for one.
+        Returns 0 if a token was taken, otherwise the number of seconds
+        until one is expected to be available.
+        """
+        deadline = time.time() + max_wait
+        self.store.incr(self.key('waiting'))
+        try:
+            while True:
+                wait = self.store.take(
+                    self.key('bucket'), self.rate, self.capacity, time.time())
+                if not wait:
+                    return 0
+                if time.time() + wait > deadline:
+                    self.store.incr(self.key('throttled'))
+                    return wait
+                time.sleep(wait)
+        finally:
+            self.store.incr(self.key('waiting'), -1)
+
+    def stats(self):
+        """
+        Returns the number of calls waiting for a token right now and
+        the number of calls that have been turned away.
+        """
+        return {
+            'waiting': self.store.get(self.key('waiting')),
+            'throttled': self.store.get(self.key('throttled')),
+        }
+
+
+_stores = {}
+
+
+def get_store(url):
+    if url not in _stores:
+        _stores[url] = (RedisBucketStore(url) if url
+                        else LocalBucketStore())
+    return _stores[url]
+
+
+def get_sms_rate_limiter():
+    """
+    Returns the rate limiter for the configured SMS_CHANNEL, or None if
+    that channel isn't limited.
+    """
+    channel = getattr(settings, 'SMS_CHANNEL', None) or 'VUMI_GO'
+    limit = settings.SMS_RATE_LIMITS.get(channel)
+    if not limit:
+        return None
+    return RateLimiter(
+        'sms:%s' % (channel,), limit['rate'], limit['capacity'],
+        get_store(settings.SMS_RATE_LIMIT_REDIS_URL))
@@ -1,99 +1,410 @@
 import json
+import logging
 import requests
-import os
+import smtplib
+import time
+from datetime import timedelta
 
 from django.conf import settings
+from django.contrib.sites.models import Site
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import caches
 from django.template.loader import render_to_string
-from django.core.mail import send_mail
+from django.utils import timezone
+from django.core.mail import get_connection, send_mail
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
 from rest_framework.authtoken.models import Token
 from urllib.parse import urlunparse
 
+from celery import group
+from celery.exceptions import MaxRetriesExceededError
+from concurrent.futures import ThreadPoolExecutor
+
 from malaria24 import celery_app
+from malaria24.ona.pdf import get_pdf_pool
+from malaria24.ona.ratelimit import get_sms_rate_limiter
 from malaria24.ona.models import (ReportedCase, SMS, Digest, Facility, OnaForm,
                                   Email, NationalDigest, ProvincialDigest,
-                                  DistrictDigest)
-
-from onapie.client import Client
+                                  DistrictDigest, OutboxMessage,
+                                  DailyCaseRollup, OnaFormListing)
 
+from go_http.exceptions import UserOptedOutException
 from go_http.send import HttpApiSender
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
-from onapie.utils import Connection, ConnectionSingleton
+
+CASE_EMAIL_CACHE = 'case_email'
+
+_ona_session = None
 
 
-# This function is needed as Onapie doesn't yet support Python 3,
-# once Python 3 is supported this can be removed.
-# The functions sets the singleton instance of the client such that
-# it does not need to be instantiated by Onapie, which no longer works in Python 3
-def connect_client(api_addr):
-    con = Connection(api_addr)
-    ConnectionSingleton._instance = con
+def ona_session():
+    """
+    Returns the session used for all requests to the Ona API.
+
+    It is built the first time it is needed and kept for the life of the
+    process, so every worker reuses a pool of keep-alive connections
+    rather than doing a new TCP/TLS handshake for each request.
+    """
+    global _ona_session
+    if _ona_session is None:
+        session = requests.Session()
+        session.mount(settings.ONA_API_URL, HTTPAdapter(
+            pool_maxsize=settings.ONA_CONNECTION_POOL_SIZE))
+        session.headers.update({
+            'Authorization': 'Token %s' % (settings.ONAPIE_ACCESS_TOKEN,),
+        })
+        _ona_session = session
+    return _ona_session
 
 
 @celery_app.task(ignore_result=True)
 def ona_fetch_forms():
-    client = connect_client(
-        settings.ONA_API_URL
-    )
-    client = Client(settings.ONA_API_URL,
-                    api_token=settings.ONAPIE_ACCESS_TOKEN,
-                    api_entrypoint='/api/v1/')
-    for ona_form in client.forms.list():
-        form, _ = OnaForm.objects.get_or_create(uuid=ona_form['uuid'])
-        form.title = ona_form['title']
-        form.id_string = ona_form['id_string']
-        form.form_id = ona_form['formid']
-        form.save()
+    """
+    Syncs the forms listed in Ona, only writing the forms that are new or
+    have changed.
+
+    The ETag and Last-Modified of the previous listing are sent along
+    so that an unchanged listing costs a single 304 response.
+    """
+    listing = OnaFormListing.objects.first()
+    headers = {}
+    if listing and listing.etag:
+        headers['If-None-Match'] = listing.etag
+    if listing and listing.last_modified:
+        headers['If-Modified-Since'] = listing.last_modified
+    r = ona_session().get(
+        '%s/api/v1/forms' % (settings.ONA_API_URL,), headers=headers)
+    if r.status_code == 304:
+        return
+    r.raise_for_status()
+
+    forms = dict((form.uuid, form) for form in OnaForm.objects.all())
+    for ona_form in r.json():
+        values = {
+            'title': ona_form['title'],
+            'id_string': ona_form['id_string'],
+            'form_id': str(ona_form['formid']),
+        }
+        form = forms.get(ona_form['uuid'])
+        if form is None:
+            OnaForm.objects.create(uuid=ona_form['uuid'], **values)
+            continue
+        changed = [field for field, value in values.items()
+                   if getattr(form, field) != value]
+        if changed:
+            for field in changed:
+                setattr(form, field, values[field])
+            form.save(update_fields=changed + ['updated_at'])
+
+    # Saving the forms above cleared the previous listing
+    validators = {
+        'etag': r.headers.get('ETag', ''),
+        'last_modified': r.headers.get('Last-Modified', ''),
+    }
+    if any(validators.values()):
+        OnaFormListing.objects.update_or_create(pk=1, defaults=validators)
 
 
 @celery_app.task(ignore_result=True)
 def ona_fetch_reported_cases():
-    return dict(
-        [(form.form_id, ona_fetch_reported_case_for_form(form.form_id))
-         for form in OnaForm.objects.filter(active=True)])
+    """
+    Fans out a sync task per active form so forms are fetched
+    concurrently by the workers. Each sync logs its own summary, so
+    this doesn't need a result backend.
+    """
+    form_ids = list(OnaForm.objects.filter(active=True).values_list(
+        'form_id', flat=True))
+    if not form_ids:
+        return
+    logging.info('Syncing %s forms.' % (len(form_ids),))
+    group(ona_sync_reported_case_for_form.s(form_id)
+          for form_id in form_ids).apply_async()
+
+
+@celery_app.task(ignore_result=True)
+def ona_sync_reported_case_for_form(form_id):
+    start = time.time()
+    uuids = ona_fetch_reported_case_for_form(form_id)
+    logging.info('Imported %s cases for form %s in %.2f seconds.' % (
+        len(uuids), form_id, time.time() - start))
+
+
+def ona_fetch_form_data(form_id, since_id=None, page_size=None):
+    """
+    Yields the submissions for a form one page at a time, optionally
+    only those with an ``_id`` greater than ``since_id``.
+
+    Submissions are sorted by ``_id`` so every page moves the sync
+    checkpoint forward and only one page is ever held in memory.
+    """
+    page_size = page_size or settings.ONA_DATA_PAGE_SIZE
+    params = {
+        'sort': json.dumps({'_id': 1}),
+        'page_size': page_size,
+    }
+    if since_id is not None:
+        params['query'] = json.dumps({'_id': {'$gt': since_id}})
+    page = 1
+    while True:
+        params['page'] = page
+        r = ona_session().get(
+            '%s/api/v1/data/%s' % (settings.ONA_API_URL, form_id),
+            params=params)
+        # Ona responds with a 404 when asked for a page past the end
+        if r.status_code == 404 and page > 1:
+            return
+        r.raise_for_status()
+        submissions = r.json()
+        if submissions:
+            yield submissions
+        if len(submissions) < page_size:
+            return
+        page += 1
+
+
+def reported_case_from_submission(ona_form, data):
+    case = ReportedCase(
+        form=ona_form,
+        first_name=data.get('first_name') or "",
+        last_name=data.get('last_name') or "",
+        locality=data.get('locality') or '_other',
+        date_of_birth=data.get('date_of_birth'),
+        create_date_time=data.get('create_date_time'),
+        sa_id_number=data.get('sa_id_number'),
+        msisdn=data.get('msisdn'),
+        id_type=data.get('id_type'),
+        abroad=data.get('abroad'),
+        reported_by=data.get('reported_by'),
+        gender=data.get('gender'),
+        facility_code=data.get('facility_code'),
+        landmark=data.get('landmark'),
+        landmark_description=data.get('landmark_description'),
+        case_number=data.get('case_number'),
+        _id=data['_id'],
+        _uuid=data['_uuid'],
+        _xform_id_string=data['_xform_id_string'])
+    # bulk_create doesn't call save(), which normally does this
+    case.normalize()
+    return case
+
+
+def import_submissions(ona_form, submissions):
+    """
+    Imports a batch of Ona submissions for a form, skipping any that
+    have already been imported. Duplicates are detected with a single
+    indexed query and new cases are written with a bulk insert.
+
+    The form's row is locked while inserting so overlapping pulls of the
+    same form are serialised, anything else that collides on the unique
+    ``_uuid`` index is ignored.
+
+    ``bulk_create`` doesn't send ``post_save`` so it is sent here once
+    for every new case, in the same transaction as the insert, which
+    writes the usual new case alerts to the outbox. It is sent with
+    ``bulk=True`` as the daily rollups are updated for all the new cases
+    at once.
+    """
+    submissions = dict(
+        (data['_uuid'], data) for data in submissions)
+    if not submissions:
+        return []
+
+    with transaction.atomic():
+        OnaForm.objects.select_for_update().get(pk=ona_form.pk)
+        existing = set(ReportedCase.objects.filter(
+            _uuid__in=submissions.keys()).values_list('_uuid', flat=True))
+        new_cases = [
+            reported_case_from_submission(ona_form, data)
+            for uuid, data in submissions.items() if uuid not in existing]
+        ReportedCase.objects.bulk_create(new_cases, ignore_conflicts=True)
+
+        uuids = [case._uuid for case in new_cases]
+        created = dict(
+            (case._uuid, case)
+            for case in ReportedCase.objects.filter(_uuid__in=uuids))
+        DailyCaseRollup.add_cases([created[uuid] for uuid in uuids])
+        for uuid in uuids:
+            post_save.send(sender=ReportedCase, instance=created[uuid],
+                           created=True, raw=False,
+                           using=ReportedCase.objects.db, update_fields=None,
+                           bulk=True)
+    return uuids
 
 
 @celery_app.task(ignore_result=True)
 def ona_fetch_reported_case_for_form(form_id):
-    client = connect_client(
-        settings.ONA_API_URL
-    )
-    client = Client(settings.ONA_API_URL,
-                    api_token=settings.ONAPIE_ACCESS_TOKEN,
-                    api_entrypoint='/api/v1/')
-    form_data_list = client.data.get(form_id)
+    ona_form = OnaForm.objects.get(form_id=form_id)
+    since_id = ona_form.last_submission_id
     uuids = []
-    for data in form_data_list:
-        if ReportedCase.objects.filter(_uuid=data['_uuid']).exists():
-            continue
-
-        case = ReportedCase.objects.create(
-            form=OnaForm.objects.get(form_id=form_id),
-            first_name=data.get('first_name') or "",
-            last_name=data.get('last_name') or "",
-            locality=data.get('locality') or '_other',
-            date_of_birth=data.get('date_of_birth'),
-            create_date_time=data.get('create_date_time'),
-            sa_id_number=data.get('sa_id_number'),
-            msisdn=data.get('msisdn'),
-            id_type=data.get('id_type'),
-            abroad=data.get('abroad'),
-            reported_by=data.get('reported_by'),
-            gender=data.get('gender'),
-            facility_code=data.get('facility_code'),
-            landmark=data.get('landmark'),
-            landmark_description=data.get('landmark_description'),
-            case_number=data.get('case_number'),
-            _id=data['_id'],
-            _uuid=data['_uuid'],
-            _xform_id_string=data['_xform_id_string'])
-        uuids.append(case._uuid)
+    for page in ona_fetch_form_data(form_id, since_id=since_id):
+        submissions = [
+            data for data in page
+            if since_id is None or int(data['_id']) > since_id]
+        uuids.extend(import_submissions(ona_form, submissions))
+        ona_form.update_checkpoint(
+            max([int(data['_id']) for data in submissions], default=None))
     return uuids
 
 
 @celery_app.task(ignore_result=True)
-def send_sms(to, content):
+def dispatch_outbox(batch_size=None):
+    """
+    Sends the outbox messages that haven't been dispatched yet to the
+    broker, a batch at a time.
+
+    Each batch is claimed in a short transaction of its own, so
+    concurrent dispatchers don't send the same message, and it is then
+    published without holding any locks. A batch that is claimed but
+    never marked as dispatched, because the dispatcher died, can be
+    claimed again after OUTBOX_CLAIM_TIMEOUT seconds, so delivery is at
+    least once.
+
+    A message that can't be sent has its attempt counted and the error
+    recorded, and is tried again by the next dispatch. After
+    OUTBOX_MAX_ATTEMPTS it is left for someone to look at, without
+    holding up the messages after it.
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    dispatched = 0
+    last_pk = 0
+    while True:
+        claimed_at = timezone.now()
+        unclaimed = Q(claimed_at__isnull=True)
+        expired = Q(claimed_at__lt=claimed_at - timedelta(
+            seconds=settings.OUTBOX_CLAIM_TIMEOUT))
+        with transaction.atomic():
+            messages = list(
+                OutboxMessage.objects.select_for_update(skip_locked=True)
+                .filter(unclaimed | expired, dispatched_at__isnull=True,
+                        pk__gt=last_pk,
+                        attempts__lt=settings.OUTBOX_MAX_ATTEMPTS)
+                .order_by('pk')[:batch_size])
+            if not messages:
+                return dispatched
+            OutboxMessage.objects.filter(
+                pk__in=[message.pk for message in messages]).update(
+                    claimed_at=claimed_at)
+        last_pk = messages[-1].pk
+        sent, failed = send_outbox_messages(messages)
+        OutboxMessage.objects.filter(
+            pk__in=[message.pk for message in sent]).update(
+                dispatched_at=timezone.now())
+        for message, error in failed:
+            logging.error('Unable to dispatch outbox message %s: %s' % (
+                message.pk, error))
+            message.attempts += 1
+            message.last_error = '%r' % (error,)
+            message.claimed_at = None
+        OutboxMessage.objects.bulk_update(
+            [message for message, _ in failed],
+            ['attempts', 'last_error', 'claimed_at'])
+        dispatched += len(sent)
+
+
+@celery_app.task(ignore_result=True)
+def purge_outbox():
+    """
+    Deletes the outbox messages dispatched more than OUTBOX_RETENTION_DAYS
+    days ago, so the outbox only keeps recent history.
+    """
+    deleted, _ = OutboxMessage.objects.filter(
+        dispatched_at__lt=timezone.now() - timedelta(
+            days=settings.OUTBOX_RETENTION_DAYS)).delete()
+    logging.info('Purged %s dispatched outbox messages.' % (deleted,))
+    return deleted
+
+
+def send_outbox_messages(messages):
+    """
+    Publishes the outbox ``messages`` and returns the list of messages
+    sent and a list of ``(message, error)`` for the ones that weren't.
+
+    SMSs and case emails are sent in batches rather than a task each, a
+    failure to publish a batch counts against all its messages.
+    """
+    sent = []
+    failed = []
+    sms = []
+    emails = []
+    for message in messages:
+        if message.task == send_sms.name:
+            call = dict(zip(['to', 'content'], message.args),
+                        **message.kwargs)
+            sms.append((message, [call['to'], call['content']]))
+            continue
+        if message.task == send_case_email.name:
+            call = dict(zip(['case_pk', 'recipients'], message.args),
+                        **message.kwargs)
+            emails.append((message, [call['case_pk'], call['recipients']]))
+            continue
+        try:
+            celery_app.tasks[message.task].apply_async(
+                args=message.args, kwargs=message.kwargs)
+        except Exception as e:
+            failed.append((message, e))
+        else:
+            sent.append(message)
+
+    for task, calls, size in [
+            (send_sms_batch, sms, settings.SMS_BATCH_SIZE),
+            (send_case_email_batch, emails, settings.EMAIL_BATCH_SIZE)]:
+        for i in range(0, len(calls), size):
+            batch = calls[i:i + size]
+            try:
+                task.apply_async(args=[[call for _, call in batch]])
+            except Exception as e:
+                failed.extend([(message, e) for message, _ in batch])
+            else:
+                sent.extend([message for message, _ in batch])
+    return sent, failed
+
+
+_junebug_event_config = None
+
+
+def junebug_event_config():
+    """
+    Returns the URL and auth token Junebug sends message events to.
+
+    They are kept for JUNEBUG_EVENT_CONFIG_TTL seconds in the process,
+    and forgotten as soon as the site or a token is changed here. The
+    TTL bounds how long other processes take to notice a change.
+    """
+    global _junebug_event_config
+    config = _junebug_event_config
+    if config is None or config[0] < time.time():
+        site = get_current_site(None)
+        event_url = urlunparse(
+            ('http', site.domain, '/api/v1/event/', '', '', ''))
+        event_token = Token.objects.get(user__username='junebug')
+        config = _junebug_event_config = (
+            time.time() + settings.JUNEBUG_EVENT_CONFIG_TTL,
+            event_url, event_token.key)
+    return config[1:]
+
+
+def clear_junebug_event_config(**kwargs):
+    global _junebug_event_config
+    _junebug_event_config = None
+
+
+for model in [Site, Token]:
+    post_save.connect(clear_junebug_event_config, sender=model)
+    post_delete.connect(clear_junebug_event_config, sender=model)
+
+
+def sms_sender(session):
+    """
+    Returns a function that sends an SMS with the configured channel over
+    ``session`` and returns the message id.
+
+    Anything the channel needs beyond the message itself is looked up
+    here, once, rather than for every message sent.
+    """
     channel = getattr(settings, 'SMS_CHANNEL', None)
     # Send with VumiGo
     if (channel is None or channel == 'VUMI_GO'):
@@ -101,8 +412,12 @@ def send_sms(to, content):
             settings.VUMI_GO_ACCOUNT_KEY,
             settings.VUMI_GO_CONVERSATION_KEY,
             settings.VUMI_GO_API_TOKEN,
-            api_url='http://go.vumi.org/api/v1/go/http_api_nostream')
-        sms = sender.send_text(to, content)
+            api_url='http://go.vumi.org/api/v1/go/http_api_nostream',
+            session=session)
+
+        def send(to, content):
+            return sender.send_text(to, content)['message_id']
+        return send
     # Send with Junebug
     elif channel == 'JUNEBUG':
         long_code = (getattr(settings, 'SMS_CODE'))
@@ -112,52 +427,258 @@ def send_sms(to, content):
 
         headers = {'content-type': 'application/json'}
         # Get the url and token for endpoint to send events to
-        site = get_current_site(None)
-        event_url = urlunparse(
-            ('http', site.domain, '/api/v1/event/', '', '', ''))
-        event_token = Token.objects.get(user__username='junebug')
-        data = {'to': to, 'content': content, 'event_url': event_url,
-                'event_auth_token': event_token.key, 'from': long_code}
-
-        data = json.dumps(data)
-        r = requests.post(
-            '%s/messages/' % jb_url, auth=jb_auth,
-            data=data, headers=headers)
-        r.raise_for_status()
-        sms = json.loads(r.content)['result']
-    SMS.objects.create(to=to, content=content, message_id=sms['message_id'])
+        event_url, event_token = junebug_event_config()
+
+        def send(to, content):
+            data = {'to': to, 'content': content, 'event_url': event_url,
+                    'event_auth_token': event_token, 'from': long_code}
+            r = session.post(
+                '%s/messages/' % jb_url, auth=jb_auth,
+                data=json.dumps(data), headers=headers)
+            r.raise_for_status()
+            return r.json()['result']['message_id']
+        return send
+    raise ValueError('Unknown SMS_CHANNEL %r.' % (channel,))
+
+
+class SMSRetry(Exception):
+    """
+    Raised when an SMS couldn't be sent right now but should be retried,
+    after ``countdown`` seconds if the provider or rate limiter said so.
+    """
+
+    def __init__(self, message, countdown=None):
+        super(SMSRetry, self).__init__(message)
+        self.countdown = countdown
+
+
+def send_rate_limited(send, to, content):
+    """
+    Sends an SMS once the channel's rate limiter allows it.
+
+    Throttling, 429s, 5xx responses and connection errors raise
+    SMSRetry, any other HTTP error is raised as is.
+    """
+    limiter = get_sms_rate_limiter()
+    if limiter is not None:
+        wait = limiter.acquire(settings.SMS_RATE_LIMIT_MAX_WAIT)
+        if wait:
+            raise SMSRetry('Rate limited.', countdown=wait)
+    try:
+        return send(to, content)
+    except requests.HTTPError as e:
+        status_code = e.response.status_code
+        if status_code != 429 and status_code < 500:
+            raise
+        retry_after = e.response.headers.get('Retry-After', '')
+        raise SMSRetry(str(e), countdown=(
+            int(retry_after) if retry_after.isdigit() else None))
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise SMSRetry(str(e))
+
+
+def sms_retry_countdown(task, countdowns):
+    """
+    Returns how long to wait before retrying, the longest wait asked for
+    or else an exponential backoff.
+    """
+    countdowns = [countdown for countdown in countdowns if countdown]
+    if countdowns:
+        return max(countdowns)
+    return min(settings.SMS_RETRY_BACKOFF * 2 ** task.request.retries,
+               settings.SMS_RETRY_BACKOFF_MAX)
+
+
+@celery_app.task(bind=True, ignore_result=True)
+def send_sms(self, to, content):
+    send = sms_sender(requests.Session())
+    try:
+        message_id = send_rate_limited(send, to, content)
+    except SMSRetry as e:
+        raise self.retry(
+            exc=e, countdown=sms_retry_countdown(self, [e.countdown]),
+            max_retries=settings.SMS_MAX_RETRIES)
+    SMS.objects.create(to=to, content=content, message_id=message_id)
+
+
+@celery_app.task(bind=True, ignore_result=True)
+def send_sms_batch(self, messages):
+    """
+    Sends a list of ``(to, content)`` SMSs over one pooled session, with
+    at most SMS_BATCH_CONCURRENCY of them in flight at a time, and
+    records them with a single insert.
+
+    Sends are paced by the channel's rate limiter. Messages that were
+    throttled or failed in a way worth retrying are retried as a new
+    batch with backoff, the ones that were sent aren't sent again.
+    """
+    concurrency = settings.SMS_BATCH_CONCURRENCY
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    send = sms_sender(session)
+
+    def send_message(message):
+        to, content = message
+        try:
+            return send_rate_limited(send, to, content), None
+        except SMSRetry as e:
+            logging.warning('Unable to send SMS to %s, retrying: %s' % (
+                to, e))
+            return None, e
+        except UserOptedOutException:
+            logging.warning('Not sending SMS to %s, they opted out.' % (to,))
+        except requests.RequestException as e:
+            logging.error('Unable to send SMS to %s: %s' % (to, e))
+        return None, None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send_message, messages))
+
+    SMS.objects.bulk_create([
+        SMS(to=to, content=content, message_id=message_id)
+        for (to, content), (message_id, _) in zip(messages, results)
+        if message_id is not None])
+    failed = [(message, retry) for message, (_, retry) in zip(
+        messages, results) if retry is not None]
+
+    limiter = get_sms_rate_limiter()
+    if limiter is not None:
+        logging.info(
+            'Sent %s of %s SMSs, %s to retry, %s waiting and %s throttled '
+            'for %s.' % (
+                len(messages) - len(failed), len(messages), len(failed),
+                limiter.stats()['waiting'], limiter.stats()['throttled'],
+                limiter.name))
+    if not failed:
+        return
+    try:
+        raise self.retry(
+            args=[[message for message, _ in failed]],
+            countdown=sms_retry_countdown(
+                self, [retry.countdown for _, retry in failed]),
+            max_retries=settings.SMS_MAX_RETRIES)
+    except MaxRetriesExceededError:
+        logging.error('Giving up on sending SMS to %s.' % (
+            ', '.join([to for (to, _), _ in failed]),))
+
+
+def get_case_email_content(case):
+    """
+    Returns the text, HTML, PDF HTML and PDF for the case email. These are
+    cached for each version of the case so that they're only rendered once
+    however many people the case is sent to.
+    """
+    key = 'case-email:%s:%s' % (case.pk, case.updated_at.isoformat())
+    content = caches[CASE_EMAIL_CACHE].get(key)
+    if content is None:
+        pdf_content = case.get_pdf_email_content()
+        content = {
+            'text': case.get_text_email_content(),
+            'html': case.get_html_email_content(),
+            'pdf_content': pdf_content,
+            'pdf': make_pdf(pdf_content),
+        }
+        caches[CASE_EMAIL_CACHE].set(key, content)
+    return content
 
 
-@celery_app.task(ignore_result=True)
-def send_case_email(case_pk, recipients):
+def make_case_email(case, recipients):
+    """
+    Returns the message for ``case`` to ``recipients`` and its content.
+    """
     from django.core.mail import EmailMultiAlternatives
 
-    case = ReportedCase.objects.get(pk=case_pk)
+    content = get_case_email_content(case)
     subject = 'Malaria case number %s' % (case.case_number,)
-    text_content = case.get_text_email_content()
-    html_content = case.get_html_email_content()
-    pdf_content = case.get_pdf_email_content()
     from_email = settings.DEFAULT_FROM_EMAIL
-    msg = EmailMultiAlternatives(subject, text_content, from_email, recipients)
-    msg.attach_alternative(html_content, "text/html")
+    msg = EmailMultiAlternatives(
+        subject, content['text'], from_email, recipients)
+    msg.attach_alternative(content['html'], "text/html")
     msg.attach('Reported_Case_%s.pdf' % (case.case_number,),
-               make_pdf(pdf_content),
+               content['pdf'],
                "application/pdf")
+    return msg, content
+
+
+@celery_app.task(ignore_result=True)
+def send_case_email(case_pk, recipients):
+    case = ReportedCase.objects.get(pk=case_pk)
+    msg, content = make_case_email(case, recipients)
     msg.send()
-    Email.objects.create(to=recipients[0], html_content=html_content,
-                         pdf_content=pdf_content)
+    Email.objects.record(
+        [(recipients, content['html'], content['pdf_content'])])
+
+
+@celery_app.task(bind=True, ignore_result=True)
+def send_case_email_batch(self, emails):
+    """
+    Sends a list of ``(case_pk, recipients)`` case emails over one SMTP
+    connection and records the ones sent all at once.
+
+    Each email is sent separately so that one failure doesn't stop the
+    rest. Emails whose recipients were all refused aren't retried, the
+    other failures are retried as a new batch with backoff.
+    """
+    cases = ReportedCase.objects.in_bulk(
+        set([case_pk for case_pk, _ in emails]))
+    messages = []
+    for case_pk, recipients in emails:
+        if case_pk not in cases:
+            logging.warning('Not emailing case %s to %s, it was deleted.' % (
+                case_pk, ', '.join(recipients)))
+            continue
+        messages.append((
+            [case_pk, recipients],
+            make_case_email(cases[case_pk], recipients)))
+    if not messages:
+        return
 
+    sent = []
+    failed = []
+    try:
+        with get_connection() as connection:
+            while messages:
+                email, (msg, content) = messages.pop(0)
+                try:
+                    connection.send_messages([msg])
+                except smtplib.SMTPRecipientsRefused as e:
+                    logging.error('Unable to email case %s to %s: %s' % (
+                        email[0], ', '.join(msg.to), e))
+                except (smtplib.SMTPException, OSError) as e:
+                    logging.warning(
+                        'Unable to email case %s to %s, retrying: %s' % (
+                            email[0], ', '.join(msg.to), e))
+                    failed.append(email)
+                else:
+                    sent.append((msg, content))
+    except (smtplib.SMTPException, OSError) as e:
+        # Opening or closing the connection failed
+        logging.warning('Unable to send case emails, retrying: %s' % (e,))
+        failed.extend([email for email, _ in messages])
+
+    if sent:
+        Email.objects.record([
+            (msg.to, content['html'], content['pdf_content'])
+            for msg, content in sent])
+    if not failed:
+        return
+    try:
+        raise self.retry(
+            args=[failed],
+            countdown=min(
+                settings.EMAIL_RETRY_BACKOFF * 2 ** self.request.retries,
+                settings.EMAIL_RETRY_BACKOFF_MAX),
+            max_retries=settings.EMAIL_MAX_RETRIES)
+    except MaxRetriesExceededError:
+        logging.error('Giving up on emailing %s.' % (', '.join([
+            'case %s to %s' % (case_pk, ', '.join(recipients))
+            for case_pk, recipients in failed]),))
 
-def make_pdf(html_content):  # pragma: no cover
-    import pdfkit
-    import tempfile
-    fd, output_file = tempfile.mkstemp()
-    pdfkit.from_string(html_content, output_file)
-    with open(output_file, 'rb') as fp:
-        value = fp.read()
-    os.close(fd)
-    os.unlink(output_file)
-    return value
+
+def make_pdf(html_content):
+    return get_pdf_pool().render(html_content)
 
 
 @celery_app.task(ignore_result=True)
@@ -185,25 +706,82 @@ def compile_and_send_digest_email():
         return digest.send_digest_email()
 
 
+FACILITY_COLUMNS = (
+    ('facility_name', 'Facility'),
+    ('province', 'Province'),
+    ('district', 'District'),
+    ('subdistrict', 'Sub-District (Locality)'),
+    ('phase', 'Phase'),
+)
+
+
+def upsert_facilities(data, wipe):
+    """
+    Inserts or updates the facilities in ``data`` keyed on their facility
+    code, in a single transaction with bulk writes.
+
+    If ``wipe`` is set the facilities not in ``data`` are also removed.
+    Returns a report of the facility codes that were inserted, updated,
+    unchanged and removed.
+    """
+    rows = dict(
+        (row['FacCode'], dict(
+            (field, row[column]) for field, column in FACILITY_COLUMNS))
+        for row in data)
+    report = {'inserted': [], 'updated': [], 'unchanged': [], 'removed': []}
+
+    with transaction.atomic():
+        existing = {}
+        for facility in Facility.objects.select_for_update():
+            existing.setdefault(facility.facility_code, []).append(facility)
+
+        new_facilities = []
+        changed_facilities = []
+        now = timezone.now()
+        for facility_code, values in rows.items():
+            facilities = existing.get(facility_code)
+            if not facilities:
+                report['inserted'].append(facility_code)
+            elif all(getattr(facility, field) == value
+                     for facility in facilities
+                     for field, value in values.items()):
+                report['unchanged'].append(facility_code)
+            else:
+                report['updated'].append(facility_code)
+                for facility in facilities:
+                    for field, value in values.items():
+                        setattr(facility, field, value)
+                    facility.updated_at = now
+                    changed_facilities.append(facility)
+
+            if not facilities:
+                new_facilities.append(
+                    Facility(facility_code=facility_code, **values))
+
+        if wipe:
+            report['removed'] = [
+                facility_code for facility_code in existing
+                if facility_code not in rows]
+            for i in range(0, len(report['removed']), 1000):
+                Facility.objects.filter(
+                    facility_code__in=report['removed'][i:i + 1000]).delete()
+        Facility.objects.bulk_update(
+            changed_facilities,
+            [field for field, _ in FACILITY_COLUMNS] + ['updated_at'],
+            batch_size=1000)
+        Facility.objects.bulk_create(new_facilities, batch_size=1000)
+    return report
+
+
 @celery_app.task(ignore_result=True)
 def import_facilities(data, wipe, email_address):
-    if wipe:
-        Facility.objects.all().delete()
-
-    for row in data:
-        facility, _ = Facility.objects.get_or_create(
-            facility_code=row['FacCode'])
-        facility.facility_name = row['Facility']
-        facility.province = row['Province']
-        facility.district = row['District']
-        facility.subdistrict = row['Sub-District (Locality)']
-        facility.phase = row['Phase']
-        facility.save()
+    report = upsert_facilities(data, wipe)
 
     if email_address:
         context = {
             'facilities': Facility.objects.all(),
             'data': data,
+            'report': report,
         }
         text_content = render_to_string(
             'ona/import_complete_email.txt', context)
@@ -215,3 +793,4 @@ def import_facilities(data, wipe, email_address):
                   from_email=settings.DEFAULT_FROM_EMAIL,
                   recipient_list=[email_address],
                   html_message=html_content)
+    return report
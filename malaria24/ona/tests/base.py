@@ -1,10 +1,12 @@
 import pkg_resources
 import random
+import uuid
 from datetime import datetime
 import pytz
 
 import responses
 
+from django.core.cache import caches
 from django.test import TestCase, override_settings
 from django.utils import timezone
 
@@ -15,6 +17,7 @@ from malaria24.ona.models import (
 @override_settings(CELERY_ALWAYS_EAGER=True)
 class MalariaTestCase(TestCase):
     def setUp(self):
+        caches['case_email'].clear()
         responses.add(
             responses.PUT,
             ('http://go.vumi.org/api/v1/go/http_api_nostream/'
@@ -90,9 +93,12 @@ class MalariaTestCase(TestCase):
             'landmark': 'landmark',
             'landmark_description': 'landmark_description',
             '_id': '_id',
-            '_uuid': '_uuid',
+            '_uuid': uuid.uuid4().hex,
             '_xform_id_string': '_xform_id_string',
             'digest': None,
         }
         defaults.update(kwargs)
-        return ReportedCase.objects.create(**defaults)
+        # Dispatch the outbox as if the case had been created in a
+        # transaction that committed
+        with self.captureOnCommitCallbacks(execute=True):
+            return ReportedCase.objects.create(**defaults)
@@ -1,11 +1,13 @@
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.db import connection
 from django.db.models.signals import post_save
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from mock import patch
 
 from malaria24.ona.models import (
-    ReportedCase,
+    ReportedCase, Email,
     new_case_alert_ehps,
     new_case_alert_mis, new_case_alert_jembi)
 
@@ -123,3 +125,40 @@ class ReportedCaseAdminTest(MalariaTestCase):
         mock_task.assert_any_call(case2.pk)
         self.assertContains(response,
                             "Forwarding all unsent cases to Jembi (total 2).")
+
+
+class EmailAdminTest(MalariaTestCase):
+    def setUp(self):
+        super(EmailAdminTest, self).setUp()
+        User.objects.create_superuser(
+            username='test',
+            password='test',
+            email='test@test.com'
+        )
+        self.client.login(username='test', password='test')
+        Email.objects.record([
+            (['ehp1@example.org', 'ehp2@example.org'], '<p>Case 1</p>',
+             'pdf 1'),
+            (['ehp3@example.org'], '<p>Case 2</p>', 'pdf 2'),
+        ])
+
+    def test_changelist_does_not_load_content(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('admin:ona_email_changelist'))
+        self.assertContains(response, 'ehp1@example.org')
+        self.assertContains(response, 'ehp3@example.org')
+        self.assertFalse(any(
+            'ona_emailcontent' in query['sql'] for query in queries))
+
+    def test_email_view(self):
+        email = Email.objects.get(to='ehp3@example.org')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('admin:email_view', args=[email.pk]))
+        self.assertEqual(response.content, b'<p>Case 2</p>')
+        # Only the HTML content is loaded
+        [query] = [query['sql'] for query in queries
+                   if 'ona_emailcontent' in query['sql']]
+        self.assertIn('html_content', query)
+        self.assertNotIn('pdf_content', query)
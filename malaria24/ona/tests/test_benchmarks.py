@@ -0,0 +1,123 @@
+import json
+from io import StringIO
+
+import requests
+
+from django.core.management import call_command
+
+from malaria24.ona.benchmarks import (
+    benchmark_digests, benchmark_ingestion, make_national_dataset)
+from malaria24.ona.fake_ona import FakeOnaServer
+from malaria24.ona.models import (
+    DailyCaseRollup, Facility, OnaForm, OutboxMessage, ReportedCase)
+
+from .base import MalariaTestCase
+
+
+class DigestBenchmarkTest(MalariaTestCase):
+
+    def test_make_national_dataset(self):
+        make_national_dataset(facilities=90, cases=200,
+                              districts_per_province=2, managers_per_scope=1)
+        self.assertEqual(Facility.objects.count(), 90)
+        self.assertEqual(
+            Facility.objects.values('district').distinct().count(), 18)
+        self.assertEqual(
+            ReportedCase.objects.filter(digest__isnull=True).count(), 200)
+        self.assertFalse(
+            ReportedCase.objects.filter(birth_date__isnull=True).exists())
+
+    def test_digest_queries_dont_grow_with_the_dataset(self):
+        make_national_dataset(facilities=90, cases=200,
+                              districts_per_province=2, managers_per_scope=2)
+        national, provincial, district, digest = benchmark_digests()
+        self.assertEqual(national['emails'], 1)
+        self.assertEqual(provincial['emails'], 18)
+        self.assertEqual(district['emails'], 36)
+        self.assertEqual(digest['emails'], 1)
+        # These are bounded by the number of digests sent, not the number
+        # of cases or facilities
+        self.assertLessEqual(national['queries'], 10)
+        self.assertLessEqual(provincial['queries'], 10)
+        self.assertLessEqual(district['queries'], 10)
+
+    def test_benchmark_digests_command(self):
+        out = StringIO()
+        call_command('benchmark_digests', facilities=20, cases=50,
+                     districts_per_province=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(
+            lines[0].startswith('Created 20 facilities and 50 cases in '))
+        self.assertEqual(
+            [line.split()[0] for line in lines[1:]],
+            ['digest', 'national', 'provincial', 'district', 'digest'])
+        # The dataset is rolled back
+        self.assertEqual(Facility.objects.count(), 0)
+        self.assertEqual(ReportedCase.objects.count(), 0)
+
+
+class FakeOnaServerTest(MalariaTestCase):
+
+    def test_forms(self):
+        with FakeOnaServer(forms=2) as server:
+            r = requests.get('%s/api/v1/forms' % (server.url,))
+            self.assertEqual(
+                [form['formid'] for form in r.json()], [12345, 12346])
+            r = requests.get('%s/api/v1/forms' % (server.url,), headers={
+                'If-None-Match': r.headers['ETag']})
+            self.assertEqual(r.status_code, 304)
+
+    def test_data_pages(self):
+        with FakeOnaServer(forms=1, submissions=5) as server:
+            url = '%s/api/v1/data/12345' % (server.url,)
+            self.assertEqual(len(requests.get(url).json()), 5)
+            params = {'page_size': 2, 'page': 3}
+            self.assertEqual(
+                [data['_id'] for data in requests.get(
+                    url, params=params).json()], [5])
+            params['page'] = 4
+            self.assertEqual(
+                requests.get(url, params=params).status_code, 404)
+            params = {'page_size': 2, 'page': 1,
+                      'query': json.dumps({'_id': {'$gt': 3}})}
+            self.assertEqual(
+                [data['_id'] for data in requests.get(
+                    url, params=params).json()], [4, 5])
+
+
+class IngestionBenchmarkTest(MalariaTestCase):
+
+    def test_benchmark_ingestion(self):
+        OnaForm.objects.create(uuid='real', form_id='1', active=True)
+        result = benchmark_ingestion(
+            submissions=25, forms=2, page_size=10,
+            facility_codes=['0001', '0002'], trace_memory=True)
+        self.assertEqual(result['submissions'], 25)
+        self.assertEqual(
+            ReportedCase.objects.filter(facility_code='0001').count(), 13)
+        self.assertEqual(sum(DailyCaseRollup.objects.values_list(
+            'cases', flat=True)), 25)
+        self.assertLess(result['queries_per_submission'], 12)
+        self.assertTrue(result['peak_memory'] > 0)
+        # The alerts are queued, the rollback means they're never sent
+        self.assertTrue(OutboxMessage.objects.exists())
+        self.assertEqual(OutboxMessage.objects.filter(
+            dispatched_at__isnull=False).count(), 0)
+        self.assertEqual(
+            list(OnaForm.objects.filter(active=True).values_list(
+                'form_id', flat=True).order_by('form_id')),
+            ['12345', '12346'])
+
+    def test_benchmark_ingestion_command(self):
+        out = StringIO()
+        call_command('benchmark_ingestion', submissions=10,
+                     trace_memory=True, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(
+            lines[0].startswith('Imported 10 submissions in '))
+        self.assertEqual(
+            [line.split(':')[0] for line in lines[1:]],
+            ['Submissions per second', 'Queries per submission',
+             'Peak memory'])
+        self.assertEqual(ReportedCase.objects.count(), 0)
+        self.assertEqual(OnaForm.objects.count(), 0)
@@ -1,9 +1,14 @@
 from django.core import mail
+from django.db import connection
 from django.db.models.signals import post_save
+from django.template.loader import render_to_string
 from django.test import override_settings
-from datetime import datetime
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import date, datetime, timedelta
 from testfixtures import LogCapture
 from mock import patch
+import zlib
 
 
 import responses
@@ -13,8 +18,10 @@ from malaria24.ona.models import (
     new_case_alert_ehps, new_case_alert_case_investigators,
     new_case_alert_mis, new_case_alert_jembi,
     MANAGER_DISTRICT, MIS, MANAGER_NATIONAL, DistrictDigest,
-    MANAGER_PROVINCIAL, Facility, NationalDigest, ProvincialDigest)
+    MANAGER_PROVINCIAL, Facility, NationalDigest, ProvincialDigest,
+    CalculationsMixin, DailyCaseRollup, Email, EmailContent, OnaForm)
 from malaria24.ona import tasks
+from malaria24.ona.fake_ona import generate_submissions
 
 from .base import MalariaTestCase
 
@@ -179,6 +186,35 @@ class MISTest(MalariaTestCase):
 
         self.assertEqual(len(mail.outbox), 1)
 
+    @responses.activate
+    def test_email_rendered_once_for_all_recipients(self):
+        facility = Facility.objects.create(facility_code='0001',
+                                           facility_name='Facility 1',
+                                           district='The District',
+                                           subdistrict='The Subdistrict',
+                                           province='The Province')
+        self.mk_mis(province=facility.province,
+                    email_address='mis1@example.org')
+        self.mk_mis(province=facility.province,
+                    email_address='mis2@example.org')
+        with patch.object(tasks, 'make_pdf') as mock_make_pdf:
+            mock_make_pdf.return_value = 'garbage for testing'
+            case = self.mk_case(facility_code=facility.facility_code)
+            self.assertEqual(mock_make_pdf.call_count, 1)
+
+            self.assertEqual(
+                sorted([message.to for message in mail.outbox]),
+                [['mis1@example.org'], ['mis2@example.org']])
+            [body1, body2] = [message.body for message in mail.outbox]
+            self.assertEqual(body1, body2)
+
+            # A changed case is rendered again
+            case.first_name = 'Changed'
+            case.save()
+            tasks.send_case_email(case.pk, ['mis1@example.org'])
+            self.assertEqual(mock_make_pdf.call_count, 2)
+        self.assertTrue('Changed' in mail.outbox[-1].alternatives[0][0])
+
 
 class EhpReportedCaseTest(MalariaTestCase):
 
@@ -387,6 +423,60 @@ class EhpReportedCaseTest(MalariaTestCase):
             case = self.mk_case(date_of_birth="1982-01-01")
             self.assertEqual(33, case.age)
 
+    @responses.activate
+    def test_birth_date(self):
+        case = self.mk_case(date_of_birth="1982-01-31")
+        self.assertEqual(case.birth_date, date(1982, 1, 31))
+        case.date_of_birth = '920827'
+        case.save()
+        case.refresh_from_db()
+        self.assertEqual(case.birth_date, date(1992, 8, 27))
+        case.date_of_birth = 'unknown'
+        case.save()
+        self.assertEqual(case.birth_date, None)
+
+    @responses.activate
+    def test_calculate_over_under_5(self):
+        today = datetime.today()
+        self.mk_case(date_of_birth=(
+            today - timedelta(days=5 * 365)).strftime('%Y-%m-%d'))
+        self.mk_case(date_of_birth=(
+            today - timedelta(days=5 * 365 - 1)).strftime('%Y-%m-%d'))
+        self.mk_case(date_of_birth=today.strftime('%y%m%d'))
+        self.assertEqual(
+            [case.age >= 5 for case in ReportedCase.objects.order_by('pk')],
+            [True, False, False])
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                CalculationsMixin().calculate_over_under_5(
+                    ReportedCase.objects.all()),
+                (1, 2))
+
+    @responses.activate
+    def test_travel_country(self):
+        self.assertEqual(
+            [ReportedCase.parse_travel_country(abroad) for abroad in [
+                'Somalia', ' zimbabwe ', 'Went to Mozambique', 'No', 'none',
+                'kenya', '', None]],
+            ['Somalia', 'Zimbabwe', 'Mozambique', 'No', 'No', 'Kenya', '',
+             ''])
+        case = self.mk_case(abroad='ethiopia')
+        self.assertEqual(case.travel_country, 'Ethiopia')
+
+    @responses.activate
+    def test_calculate_travelhistory(self):
+        for abroad in ['Somalia', 'Somalia', 'Zambia', 'No', 'Kenya', '1']:
+            self.mk_case(abroad=abroad)
+        calculations = CalculationsMixin()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                calculations.calculate_travelhistory(
+                    ReportedCase.objects.all()),
+                (2, 0, 0, 1, 0, 2))
+        self.assertEqual(
+            calculations.noInternationalTravel(ReportedCase.objects.all()),
+            1)
+
     @responses.activate
     def test_facility_name(self):
         Facility.objects.create(facility_code='0001',
@@ -433,7 +523,7 @@ class JembiReportedCaseTest(MalariaTestCase):
         self.assertEqual(case.get_data(), d)
 
     @override_settings(FORWARD_TO_JEMBI=False)
-    @patch('malaria24.ona.tasks.compile_and_send_jembi.delay')
+    @patch('malaria24.ona.tasks.compile_and_send_jembi.apply_async')
     def test_setting_prevents_task_call(self, mock_task):
         case = self.mk_case(first_name="John", last_name="Day", gender="male",
                             msisdn="0711111111", landmark_description="None",
@@ -446,7 +536,7 @@ class JembiReportedCaseTest(MalariaTestCase):
         case.digest = None
         self.assertFalse(mock_task.called)
 
-    @patch('malaria24.ona.tasks.compile_and_send_jembi.delay')
+    @patch('malaria24.ona.tasks.compile_and_send_jembi.apply_async')
     def test_case_creation_triggers_task(self, mock_task):
         case = self.mk_case(first_name="John", last_name="Day", gender="male",
                             msisdn="0711111111", landmark_description="None",
@@ -457,7 +547,7 @@ class JembiReportedCaseTest(MalariaTestCase):
                             landmark="School", facility_code="123456")
         case.save()
         case.digest = None
-        mock_task.assert_called_with(case.pk)
+        mock_task.assert_called_with(args=[case.pk], kwargs={})
 
 
 class DigestTest(MalariaTestCase):
@@ -706,6 +796,84 @@ class DigestTest(MalariaTestCase):
         self.assertEqual(
             data['week'], self.get_week(ReportedCase.objects.all()))
 
+    @responses.activate
+    def test_national_digest_email_data_breakdown(self):
+        self.mk_facility(facility_code='0001', facility_name='Facility 1',
+                         province='Limpopo', district='Example1')
+        self.mk_facility(facility_code='0002', facility_name='Facility 2',
+                         province='Limpopo', district='Example1')
+        self.mk_facility(facility_code='0003', facility_name='Facility 3',
+                         province='Gauteng', district='Example2')
+        self.mk_facility(facility_code='0004', facility_name='Facility 4',
+                         province='Gauteng', district='Example3')
+        self.mk_case(facility_code='0001', gender='female', abroad='No',
+                     date_of_birth='1980-01-01')
+        self.mk_case(facility_code='0002', gender='male', abroad='Somalia',
+                     date_of_birth=datetime.today().strftime('%y%m%d'))
+        self.mk_case(facility_code='0002', gender='male',
+                     abroad='Zimbabwe', date_of_birth='1980-01-01')
+        self.mk_case(facility_code='0003', gender='Female', abroad='Kenya',
+                     date_of_birth='1980-01-01')
+        self.mk_case(facility_code='9999', date_of_birth='1980-01-01')
+
+        digest = NationalDigest.compile_digest()
+        with self.assertNumQueries(3):
+            data = digest.get_digest_email_data()
+
+        [gauteng2, gauteng3, limpopo] = data['provinces']
+        self.assertEqual(
+            [(row['province'], row['district'])
+             for row in data['provinces']],
+            [('Gauteng', 'Example2'), ('Gauteng', 'Example3'),
+             ('Limpopo', 'Example1')])
+        self.assertEqual(limpopo['cases'], 3)
+        self.assertEqual(limpopo['females'], 1)
+        self.assertEqual(limpopo['males'], 2)
+        self.assertEqual(limpopo['under5'], 1)
+        self.assertEqual(limpopo['over5'], 2)
+        self.assertEqual(limpopo['no_international_travel'], 1)
+        self.assertEqual(limpopo['somalia'], 1)
+        self.assertEqual(limpopo['zimbabwe'], 1)
+        self.assertEqual(limpopo['other'], 0)
+        self.assertEqual(gauteng2['cases'], 1)
+        self.assertEqual(gauteng2['females'], 1)
+        self.assertEqual(gauteng2['other'], 1)
+        self.assertEqual(gauteng3['cases'], 0)
+        self.assertEqual(data['totals']['total_cases'], 4)
+        self.assertEqual(data['totals']['total_over5'], 3)
+
+    def test_district_digest_email_data_breakdown(self):
+        for i in range(20):
+            self.mk_facility(facility_code='%04d' % (i,),
+                             facility_name='Facility %s' % (i,),
+                             province='Limpopo', district='Example1')
+        self.mk_facility(facility_code='9999', facility_name='Facility 9999',
+                         province='Gauteng', district='Example2')
+        for i in range(20):
+            self.mk_case(facility_code='%04d' % (i % 2,), gender='female',
+                         abroad='Mozambique', date_of_birth='1980-01-01')
+        self.mk_case(facility_code='9999')
+
+        digest = DistrictDigest.compile_digest()
+        # The query count doesn't depend on the number of facilities
+        with self.assertNumQueries(4):
+            data = digest.get_digest_email_data(None, '0005')
+
+        self.assertEqual(len(data['facility']), 20)
+        [facility0, facility1] = data['facility'][:2]
+        self.assertEqual(facility0['facility'], 'Facility 0')
+        self.assertEqual(facility0['district'], 'Example1')
+        self.assertEqual(facility0['cases'], 10)
+        self.assertEqual(facility0['females'], 10)
+        self.assertEqual(facility0['over5'], 10)
+        self.assertEqual(facility0['mozambique'], 10)
+        self.assertEqual(facility1['cases'], 10)
+        self.assertEqual(data['facility'][2]['cases'], 0)
+        self.assertEqual(data['totals']['total_cases'], 20)
+        self.assertEqual(data['totals']['total_mozambique'], 20)
+        self.assertEqual(data['week'], self.get_week(
+            ReportedCase.objects.filter(facility_code__in=['0000', '0001'])))
+
     @responses.activate
     def test_send_national_digest_email(self):
         Facility.objects.create(facility_code='342315',
@@ -1159,6 +1327,40 @@ class DigestTest(MalariaTestCase):
             manager1.province, manager1.facility_code)
         self.assertEqual(data['districts'][0]['females'], 10)
 
+    def test_managers_in_the_same_scope_share_a_report(self):
+        Facility.objects.create(facility_code='342315',
+                                facility_name='Facility 1',
+                                province='Limpopo',
+                                district=u'Example1')
+        Facility.objects.create(facility_code='222222',
+                                facility_name='Facility 2',
+                                province='Limpopo',
+                                district=u'Example2')
+        for i in range(3):
+            self.mk_actor(role=MANAGER_PROVINCIAL,
+                          email_address='provincial%s@example.org' % (i,),
+                          facility_code='342315')
+            self.mk_actor(role=MANAGER_DISTRICT,
+                          email_address='district%s@example.org' % (i,),
+                          district=u'Example1')
+        self.mk_actor(role=MANAGER_DISTRICT,
+                      email_address='district@example.org',
+                      facility_code='222222')
+        self.mk_case(gender='female', facility_code='342315')
+
+        with patch('malaria24.ona.models.render_to_string',
+                   wraps=render_to_string) as mock_render:
+            ProvincialDigest.compile_digest().send_digest_email()
+            self.assertEqual(mock_render.call_count, 2)
+            DistrictDigest.compile_digest().send_digest_email()
+            self.assertEqual(mock_render.call_count, 6)
+
+        self.assertEqual(len(mail.outbox), 7)
+        self.assertEqual(
+            [message.body for message in mail.outbox[3:6]],
+            [mail.outbox[3].body] * 3)
+        self.assertNotEqual(mail.outbox[3].body, mail.outbox[6].body)
+
     @responses.activate
     def test_send_with_old_and_new_data_national(self):
         Facility.objects.create(facility_code='342315',
@@ -1197,3 +1399,198 @@ class DigestTest(MalariaTestCase):
         html_content, content_type = alternative
         data = digest.get_digest_email_data()
         self.assertEqual(data['provinces'][0]['females'], 10)
+
+
+class DailyCaseRollupTest(MalariaTestCase):
+
+    def setUp(self):
+        super(DailyCaseRollupTest, self).setUp()
+        post_save.disconnect(
+            new_case_alert_ehps, sender=ReportedCase)
+        post_save.disconnect(
+            new_case_alert_case_investigators, sender=ReportedCase)
+        post_save.disconnect(
+            new_case_alert_mis, sender=ReportedCase)
+        post_save.disconnect(
+            new_case_alert_jembi, sender=ReportedCase)
+
+    def tearDown(self):
+        super(DailyCaseRollupTest, self).tearDown()
+        post_save.connect(
+            new_case_alert_ehps, sender=ReportedCase)
+        post_save.connect(
+            new_case_alert_case_investigators, sender=ReportedCase)
+        post_save.connect(
+            new_case_alert_mis, sender=ReportedCase)
+        post_save.connect(
+            new_case_alert_jembi, sender=ReportedCase)
+
+    def test_rollup_incremented_on_create(self):
+        Facility.objects.create(facility_code='0001',
+                                district='Sisonke',
+                                province='KwaZulu-Natal')
+        for i in range(3):
+            self.mk_case(facility_code='0001', gender='female',
+                         date_of_birth='1990-01-01', abroad='Zambia')
+        case = self.mk_case(facility_code='0001', gender='male',
+                            date_of_birth=date.today().strftime('%y%m%d'),
+                            abroad='No')
+        # saving an existing case doesn't count it twice
+        case.save()
+
+        [female, male] = DailyCaseRollup.objects.order_by('gender')
+        self.assertEqual(female.cases, 3)
+        self.assertEqual(female.date, date.today())
+        self.assertEqual(female.district, 'Sisonke')
+        self.assertEqual(female.province, 'KwaZulu-Natal')
+        self.assertEqual(female.age_band, 'over5')
+        self.assertEqual(female.travel_country, 'Zambia')
+        self.assertEqual(male.cases, 1)
+        self.assertEqual(male.age_band, 'under5')
+        self.assertEqual(male.travel_country, 'No')
+
+    def test_rollup_other_travel(self):
+        for abroad in ['Kenya', 'malawi', 'Zambia', '']:
+            self.mk_case(facility_code='0001', gender='female',
+                         date_of_birth='1990-01-01', abroad=abroad)
+        # Anywhere that isn't reported on its own shares a row
+        self.assertEqual(
+            list(DailyCaseRollup.objects.totals('travel_country')),
+            [{'travel_country': '', 'cases': 3},
+             {'travel_country': 'Zambia', 'cases': 1}])
+        self.assertEqual(DailyCaseRollup.objects.count(), 2)
+
+    def test_get_key_create_date_time(self):
+        for create_date_time, expected in [
+                ('2024-03-05T10:00:00+02:00', date(2024, 3, 5)),
+                # Stored as midnight, but parse_datetime can't read it
+                ('2024-03-05', date(2024, 3, 5)),
+                ('not a date', timezone.localdate())]:
+            case = ReportedCase(
+                create_date_time=create_date_time, gender='female',
+                facility_code='0001', _uuid='uuid')
+            with LogCapture() as log:
+                key = DailyCaseRollup.get_key(case, facilities={})
+            self.assertEqual(key['date'], expected)
+        self.assertEqual(
+            [record.getMessage() for record in log.records],
+            ['Unable to parse the create_date_time of case uuid.'])
+
+    def test_import_date_only_create_date_time(self):
+        form = OnaForm.objects.create(uuid='uuid', form_id='1', active=True)
+        [data] = generate_submissions(1)
+        data['create_date_time'] = '2024-03-05'
+        self.assertEqual(len(tasks.import_submissions(form, [data])), 1)
+        self.assertEqual(
+            list(DailyCaseRollup.objects.values_list('date', 'cases')),
+            [(date(2024, 3, 5), 1)])
+
+    def test_totals(self):
+        Facility.objects.create(facility_code='0001', district='Sisonke',
+                                province='KwaZulu-Natal')
+        Facility.objects.create(facility_code='0002', district='Umgungundlovu',
+                                province='KwaZulu-Natal')
+        Facility.objects.create(facility_code='0003', district='Vhembe',
+                                province='Limpopo')
+        for facility_code, gender in [('0001', 'female'), ('0001', 'male'),
+                                      ('0002', 'female'), ('0003', 'male')]:
+            self.mk_case(facility_code=facility_code, gender=gender)
+
+        self.assertEqual(list(DailyCaseRollup.objects.totals('province')), [
+            {'province': 'KwaZulu-Natal', 'cases': 3},
+            {'province': 'Limpopo', 'cases': 1},
+        ])
+        self.assertEqual(
+            list(DailyCaseRollup.objects.filter(
+                province='KwaZulu-Natal').totals('district', 'gender')), [
+                {'district': 'Sisonke', 'gender': 'female', 'cases': 1},
+                {'district': 'Sisonke', 'gender': 'male', 'cases': 1},
+                {'district': 'Umgungundlovu', 'gender': 'female', 'cases': 1},
+            ])
+
+    def test_import_updates_rollup_per_page(self):
+        Facility.objects.create(facility_code='0001', district='Sisonke',
+                                province='KwaZulu-Natal')
+        Facility.objects.create(facility_code='0002', district='Vhembe',
+                                province='Limpopo')
+        # An existing rollup is added to
+        self.mk_case(facility_code='0001', gender='female',
+                     date_of_birth='1990-01-01', abroad='No')
+        form = OnaForm.objects.create(uuid='uuid', form_id='1', active=True)
+
+        queries = []
+        for start_id, count in [(1, 10), (11, 30)]:
+            submissions = generate_submissions(
+                count, start_id=start_id, facility_codes=['0001', '0002'])
+            for data in submissions:
+                data.update({'gender': 'female', 'date_of_birth': '900101',
+                             'abroad': 'No'})
+            with CaptureQueriesContext(connection) as captured:
+                tasks.import_submissions(form, submissions)
+            queries.append(len(captured))
+        # The number of queries doesn't grow with the page size
+        self.assertEqual(queries[0], queries[1])
+
+        self.assertEqual(
+            list(DailyCaseRollup.objects.totals('facility_code', 'district')),
+            [{'facility_code': '0001', 'district': 'Sisonke', 'cases': 21},
+             {'facility_code': '0002', 'district': 'Vhembe', 'cases': 20}])
+
+
+class EmailTest(MalariaTestCase):
+
+    def test_record(self):
+        with self.assertNumQueries(3):
+            Email.objects.record([
+                (['ehp1@example.org', 'ehp2@example.org'], '<p>1</p>', 'pdf'),
+                (['mis@example.org'], '<p>1</p>', 'pdf'),
+                (['ehp3@example.org'], '<p>2</p>', 'pdf'),
+            ])
+        Email.objects.record([(['ehp4@example.org'], '<p>2</p>', 'pdf')])
+
+        self.assertEqual(EmailContent.objects.count(), 2)
+        self.assertEqual(
+            sorted(Email.objects.values_list('to', 'content__html_content')),
+            [('ehp1@example.org', '<p>1</p>'),
+             ('ehp2@example.org', '<p>1</p>'),
+             ('ehp3@example.org', '<p>2</p>'),
+             ('ehp4@example.org', '<p>2</p>'),
+             ('mis@example.org', '<p>1</p>')])
+        email = Email.objects.get(to='mis@example.org')
+        self.assertEqual(email.html_content, '<p>1</p>')
+        self.assertEqual(email.pdf_content, 'pdf')
+
+    def test_content_is_compressed(self):
+        Email.objects.record([(['ehp@example.org'], '<p>1</p>' * 100, 'pdf')])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT html_content FROM ona_emailcontent')
+            [(stored,)] = cursor.fetchall()
+        self.assertTrue(len(bytes(stored)) < 100)
+        self.assertEqual(
+            zlib.decompress(bytes(stored)).decode('utf-8'), '<p>1</p>' * 100)
+        self.assertEqual(
+            EmailContent.objects.get().html_content, '<p>1</p>' * 100)
+
+
+class OnaFormTest(MalariaTestCase):
+
+    def test_update_checkpoint(self):
+        form = OnaForm.objects.create(uuid='uuid', form_id='1')
+        form.update_checkpoint(None)
+        form.refresh_from_db()
+        self.assertEqual(form.last_submission_id, None)
+        self.assertNotEqual(form.last_synced_at, None)
+
+        form.update_checkpoint(10)
+        form.refresh_from_db()
+        self.assertEqual(form.last_submission_id, 10)
+
+    def test_update_checkpoint_overlapping_sync(self):
+        form = OnaForm.objects.create(uuid='uuid', form_id='1')
+        stale = OnaForm.objects.get(pk=form.pk)
+        form.update_checkpoint(20)
+        # A sync that started before the checkpoint moved to 20
+        stale.update_checkpoint(10)
+        self.assertEqual(stale.last_submission_id, 20)
+        form.refresh_from_db()
+        self.assertEqual(form.last_submission_id, 20)
@@ -1,24 +1,48 @@
 from django.db.models.signals import post_save
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
-from datetime import datetime
+from django.utils.timezone import now
+from unittest import skipUnless
+from django.db import IntegrityError, connection, transaction
+from datetime import datetime, timedelta
 from base64 import b64encode
 import json
+import os
 import pkg_resources
+import smtplib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import responses
 import requests
+from mock import Mock, patch
+from testfixtures import LogCapture
+
+from celery.signals import worker_process_init, worker_process_shutdown
 
 from rest_framework.authtoken.models import Token
 
 from malaria24.ona.models import (
     ReportedCase, new_case_alert_ehps, MIS, MANAGER_DISTRICT, MANAGER_NATIONAL,
     MANAGER_PROVINCIAL, OnaForm, Facility, SMS, DistrictDigest,
-    NationalDigest, ProvincialDigest, new_case_alert_jembi)
+    NationalDigest, ProvincialDigest, OutboxMessage, Email,
+    EmailContent, OnaFormListing, new_case_alert_jembi)
+from malaria24.ona import pdf, ratelimit, tasks
+from malaria24.ona.pdf import PDFRenderError, PDFRenderPool
+from malaria24.ona.ratelimit import LocalBucketStore, RateLimiter
 from malaria24.ona.tasks import (
-    ona_fetch_reported_cases, compile_and_send_digest_email,
-    compile_and_send_jembi, ona_fetch_forms, send_sms)
+    ona_fetch_reported_cases, ona_fetch_reported_case_for_form,
+    compile_and_send_digest_email, compile_and_send_jembi, ona_fetch_forms,
+    ona_session, send_sms, import_facilities, dispatch_outbox,
+    send_case_email, send_case_email_batch, send_sms_batch,
+    clear_junebug_event_config, purge_outbox)
 
 from .base import MalariaTestCase
 
@@ -27,10 +51,6 @@ class OnaTest(MalariaTestCase):
 
     def setUp(self):
         super(OnaTest, self).setUp()
-        responses.add(responses.GET, 'https://odk.ona.io/api/v1/',
-                      status=200, content_type='application/json',
-                      body=pkg_resources.resource_string(
-                          'malaria24', 'ona/fixtures/responses/catalog.json'))
         responses.add(responses.GET, 'https://odk.ona.io/api/v1/data/79925',
                       status=200, content_type='application/json',
                       body=pkg_resources.resource_string(
@@ -47,6 +67,8 @@ class OnaTest(MalariaTestCase):
 
     def tearDown(self):
         super(OnaTest, self).tearDown()
+        cache.clear()
+        clear_junebug_event_config()
         post_save.connect(
             new_case_alert_ehps, sender=ReportedCase)
         post_save.connect(
@@ -57,32 +79,145 @@ class OnaTest(MalariaTestCase):
         self.assertEqual(ReportedCase.objects.count(), 0)
         form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
                                       active=True)
-        uuids = ona_fetch_reported_cases()
-        self.assertEqual(len(uuids[form.form_id]), 2)
+        uuids = ona_fetch_reported_case_for_form(form.form_id)
+        self.assertEqual(len(uuids), 2)
         self.assertEqual(ReportedCase.objects.count(), 2)
         self.assertEqual(form.reportedcase_set.count(), 2)
 
+    @responses.activate
+    def test_ona_fetch_reported_cases_fan_out(self):
+        form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
+                                      active=True)
+        OnaForm.objects.create(uuid='inactive', form_id='12345',
+                               active=False)
+        with LogCapture() as log:
+            ona_fetch_reported_cases()
+        self.assertEqual(form.reportedcase_set.count(), 2)
+        messages = [record.getMessage() for record in log.records]
+        self.assertTrue(any(
+            message.startswith('Imported 2 cases for form 79925 in ')
+            for message in messages))
+        self.assertIn('Syncing 1 forms.', messages)
+
+    @responses.activate
+    def test_ona_fetch_reported_cases_no_active_forms(self):
+        self.assertEqual(ona_fetch_reported_cases(), None)
+        self.assertEqual(len(responses.calls), 0)
+
     @responses.activate
     def test_ona_fetch_reported_cases_task_idempotency(self):
         self.assertEqual(ReportedCase.objects.count(), 0)
         form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
                                       active=True)
-        self.assertEqual(len(ona_fetch_reported_cases()[form.form_id]), 2)
-        self.assertEqual(len(ona_fetch_reported_cases()[form.form_id]), 0)
+        self.assertEqual(len(ona_fetch_reported_case_for_form(form.form_id)), 2)
+        self.assertEqual(len(ona_fetch_reported_case_for_form(form.form_id)), 0)
         self.assertEqual(ReportedCase.objects.count(), 2)
         self.assertEqual(form.reportedcase_set.count(), 2)
 
+    @responses.activate
+    def test_ona_fetch_reported_cases_task_checkpoint(self):
+        form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
+                                      active=True)
+        self.assertEqual(len(ona_fetch_reported_case_for_form(form.form_id)), 2)
+        form.refresh_from_db()
+        self.assertEqual(form.last_submission_id, 3615221)
+        self.assertNotEqual(form.last_synced_at, None)
+        self.assertNotIn('query', responses.calls[-1].request.url)
+
+        self.assertEqual(len(ona_fetch_reported_case_for_form(form.form_id)), 0)
+        self.assertIn(
+            'query=%7B%22_id%22%3A+%7B%22%24gt%22%3A+3615221%7D%7D',
+            responses.calls[-1].request.url)
+        form.refresh_from_db()
+        self.assertEqual(form.last_submission_id, 3615221)
+
+    @responses.activate
+    def test_ona_fetch_reported_cases_task_skips_checkpointed(self):
+        form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
+                                      active=True,
+                                      last_submission_id=3608910)
+        [uuid] = ona_fetch_reported_case_for_form(form.form_id)
+        self.assertEqual(uuid, '03a970b25c2740ea96a6cb517118bbef')
+        form.refresh_from_db()
+        self.assertEqual(form.last_submission_id, 3615221)
+
+    @responses.activate
+    @override_settings(ONA_DATA_PAGE_SIZE=1)
+    def test_ona_fetch_reported_cases_task_paginated(self):
+        submissions = sorted(json.loads(pkg_resources.resource_string(
+            'malaria24', 'ona/fixtures/responses/data.json')),
+            key=lambda data: data['_id'])
+
+        def paginate(request):
+            page = int(request.params['page'])
+            if page > len(submissions):
+                return (404, {}, json.dumps({'detail': 'Invalid page.'}))
+            return (200, {}, json.dumps(submissions[page - 1:page]))
+
+        responses.remove(responses.GET,
+                         'https://odk.ona.io/api/v1/data/79925')
+        responses.add_callback(
+            responses.GET, 'https://odk.ona.io/api/v1/data/79925',
+            callback=paginate, content_type='application/json')
+        form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
+                                      active=True)
+        self.assertEqual(ona_fetch_reported_case_for_form(form.form_id), [
+            '4c4799a9212245fcb564aa448444c3e0',
+            '03a970b25c2740ea96a6cb517118bbef',
+        ])
+        self.assertEqual(len(responses.calls), 3)
+        form.refresh_from_db()
+        self.assertEqual(form.last_submission_id, 3615221)
+
+    @responses.activate
+    def test_ona_fetch_reported_cases_task_skips_existing(self):
+        form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
+                                      active=True)
+        self.mk_case(_uuid='4c4799a9212245fcb564aa448444c3e0')
+        [uuid] = ona_fetch_reported_case_for_form(form.form_id)
+        self.assertEqual(uuid, '03a970b25c2740ea96a6cb517118bbef')
+        self.assertEqual(ReportedCase.objects.filter(
+            _uuid='4c4799a9212245fcb564aa448444c3e0').count(), 1)
+
+    def test_reported_case_uuid_unique(self):
+        self.mk_case(_uuid='the-uuid')
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                self.mk_case(_uuid='the-uuid')
+        self.assertEqual(ReportedCase.objects.count(), 1)
+
+    @responses.activate
+    def test_ona_fetch_reported_cases_task_sends_post_save_once(self):
+        form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
+                                      active=True)
+        receiver = Mock()
+        post_save.connect(receiver, sender=ReportedCase)
+        try:
+            ona_fetch_reported_cases()
+            ona_fetch_reported_cases()
+        finally:
+            post_save.disconnect(receiver, sender=ReportedCase)
+        self.assertEqual(receiver.call_count, 2)
+        self.assertEqual(
+            set([call[1]['instance']._uuid
+                 for call in receiver.call_args_list]),
+            set(form.reportedcase_set.values_list('_uuid', flat=True)))
+        for call in receiver.call_args_list:
+            self.assertTrue(call[1]['created'])
+            self.assertNotEqual(call[1]['instance'].pk, None)
+
     @responses.activate
     def test_ona_fetch_reported_cases_task_data_capture(self):
         form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
                                       active=True)
-        self.assertEqual(len(ona_fetch_reported_cases()[form.form_id]), 2)
+        self.assertEqual(len(ona_fetch_reported_case_for_form(form.form_id)), 2)
         case = ReportedCase.objects.get(
             _uuid='03a970b25c2740ea96a6cb517118bbef')
         self.assertEqual(case.first_name, 'XXX')
         self.assertEqual(case.last_name, 'ABC')
         self.assertEqual(case.locality, 'DEF')
         self.assertEqual(case.date_of_birth, '920827')
+        self.assertEqual(case.birth_date.isoformat(), '1992-08-27')
         self.assertEqual(case.create_date_time.year, 2015)
         self.assertEqual(case.create_date_time.month, 9)
         self.assertEqual(case.create_date_time.day, 21)
@@ -104,7 +239,7 @@ class OnaTest(MalariaTestCase):
     def test_ona_fetch_reported_cases_task_data_capture_null_locality(self):
         form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
                                       active=True)
-        self.assertEqual(len(ona_fetch_reported_cases()[form.form_id]), 2)
+        self.assertEqual(len(ona_fetch_reported_case_for_form(form.form_id)), 2)
         case = ReportedCase.objects.get(
             _uuid='4c4799a9212245fcb564aa448444c3e0')
         self.assertEqual(case.first_name, 'GHI')
@@ -334,6 +469,126 @@ class OnaTest(MalariaTestCase):
         self.assertEqual(form.form_id, '12345')
         self.assertEqual(form.active, False)
 
+    @responses.activate
+    def test_ona_fetch_forms_conditional(self):
+        forms = pkg_resources.resource_string(
+            'malaria24', 'ona/fixtures/responses/forms.json')
+
+        def conditional(request):
+            if request.headers.get('If-None-Match') == '"the-etag"':
+                return (304, {}, '')
+            return (200, {'ETag': '"the-etag"'}, forms)
+
+        responses.remove(responses.GET, 'https://odk.ona.io/api/v1/forms')
+        responses.add_callback(
+            responses.GET, 'https://odk.ona.io/api/v1/forms',
+            callback=conditional, content_type='application/json')
+        ona_fetch_forms()
+        [form] = OnaForm.objects.all()
+        # Only the stored validators are read
+        with self.assertNumQueries(1):
+            ona_fetch_forms()
+        self.assertEqual(
+            responses.calls[1].request.headers['If-None-Match'],
+            '"the-etag"')
+        self.assertEqual(responses.calls[1].response.status_code, 304)
+        self.assertEqual(OnaForm.objects.get().updated_at, form.updated_at)
+
+        # Changing the forms here means the full listing is fetched again
+        form.delete()
+        ona_fetch_forms()
+        self.assertNotIn('If-None-Match', responses.calls[2].request.headers)
+        [form] = OnaForm.objects.all()
+        self.assertEqual(
+            OnaFormListing.objects.values_list('etag', flat=True).get(),
+            '"the-etag"')
+        form.active = True
+        form.save()
+        self.assertFalse(OnaFormListing.objects.exists())
+
+    @responses.activate
+    def test_ona_fetch_forms_only_writes_changes(self):
+        ona_fetch_forms()
+        [form] = OnaForm.objects.all()
+        with self.assertNumQueries(2):
+            ona_fetch_forms()
+
+        form.title = 'old title'
+        form.save()
+        ona_fetch_forms()
+        form.refresh_from_db()
+        self.assertEqual(form.title, 'the-form-title')
+
+    @responses.activate
+    def test_ona_session_reused(self):
+        self.assertIs(ona_session(), ona_session())
+        ona_fetch_forms()
+        ona_fetch_forms()
+        self.assertEqual(len(responses.calls), 2)
+        for call in responses.calls:
+            self.assertEqual(call.request.headers['Authorization'],
+                             'Token %s' % (settings.ONAPIE_ACCESS_TOKEN,))
+
+    def mk_facility_row(self, facility_code, facility_name):
+        return {
+            'FacCode': facility_code,
+            'Facility': facility_name,
+            'Province': 'Limpopo',
+            'District': 'District',
+            'Sub-District (Locality)': 'Sub-District',
+            'Phase': 'D',
+        }
+
+    def test_import_facilities_report(self):
+        self.mk_facility(facility_code='1', facility_name='Unchanged',
+                         province='Limpopo', district='District',
+                         subdistrict='Sub-District', phase='D')
+        updated = self.mk_facility(facility_code='2', facility_name='Old')
+        self.mk_facility(facility_code='3', facility_name='Removed')
+        with self.assertNumQueries(5):
+            report = import_facilities([
+                self.mk_facility_row('1', 'Unchanged'),
+                self.mk_facility_row('2', 'Updated'),
+                self.mk_facility_row('4', 'Inserted'),
+                self.mk_facility_row('5', 'Inserted'),
+            ], False, None)
+        self.assertEqual(report, {
+            'inserted': ['4', '5'],
+            'updated': ['2'],
+            'unchanged': ['1'],
+            'removed': [],
+        })
+        self.assertEqual(
+            sorted(Facility.objects.values_list('facility_code', flat=True)),
+            ['1', '2', '3', '4', '5'])
+        facility = Facility.objects.get(facility_code='2')
+        self.assertEqual(facility.pk, updated.pk)
+        self.assertEqual(facility.facility_name, 'Updated')
+        self.assertEqual(facility.subdistrict, 'Sub-District')
+        self.assertTrue(facility.updated_at > updated.updated_at)
+
+    def test_import_facilities_wipe_report(self):
+        kept = self.mk_facility(facility_code='1', facility_name='Kept',
+                                province='Limpopo', district='District',
+                                subdistrict='Sub-District', phase='D')
+        updated = self.mk_facility(facility_code='3', facility_name='Old')
+        self.mk_facility(facility_code='2', facility_name='Removed')
+        report = import_facilities(
+            [self.mk_facility_row('1', 'Kept'),
+             self.mk_facility_row('3', 'New')], True, 'user@example.org')
+        self.assertEqual(report['removed'], ['2'])
+        self.assertEqual(report['unchanged'], ['1'])
+        self.assertEqual(report['updated'], ['3'])
+        # The facilities that are kept aren't recreated
+        [facility1, facility3] = Facility.objects.order_by('facility_code')
+        self.assertEqual(
+            (facility1.pk, facility1.created_at, facility1.updated_at),
+            (kept.pk, kept.created_at, kept.updated_at))
+        self.assertEqual(facility3.pk, updated.pk)
+        self.assertEqual(facility3.facility_name, 'New')
+        [message] = mail.outbox
+        self.assertIn('Removed: 1', message.body)
+
     @responses.activate
     def test_sms_vumi_go_if_channel_empty(self):
         """
@@ -426,6 +681,126 @@ class OnaTest(MalariaTestCase):
         [sms] = SMS.objects.all()
         self.assertEqual(sms.content, "test message")
 
+    @responses.activate
+    def test_send_sms_batch(self):
+        messages = [['+2782%s' % (i,), 'message %s' % (i,)] for i in range(3)]
+        with self.assertNumQueries(1):
+            send_sms_batch(messages)
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(
+            sorted([json.loads(call.request.body)['to_addr']
+                    for call in responses.calls]),
+            ['+27820', '+27821', '+27822'])
+        self.assertEqual(
+            sorted(SMS.objects.values_list('to', 'content')),
+            [('+27820', 'message 0'), ('+27821', 'message 1'),
+             ('+27822', 'message 2')])
+
+    @responses.activate
+    @override_settings(
+        SMS_CHANNEL='JUNEBUG',
+        JUNEBUG_CHANNEL_URL='https://example.com/junebug/CHANNEL_ID',
+        SMS_CODE='*11111')
+    def test_send_sms_batch_junebug(self):
+        jb_user = User.objects.create_user('junebug')
+        jb_token = Token.objects.create(user=jb_user)
+
+        def send(request):
+            data = json.loads(request.body)
+            return (201, {}, json.dumps({'result': {
+                'message_id': 'id-%s' % (data['to'],)}}))
+        responses.add_callback(
+            responses.POST, 'https://example.com/junebug/CHANNEL_ID/messages/',
+            callback=send, content_type='application/json')
+
+        # The site and event token are looked up once for the whole batch
+        with self.assertNumQueries(3):
+            send_sms_batch([['+27820', 'hi'], ['+27821', 'hi']])
+        self.assertEqual(
+            set(json.loads(call.request.body)['event_auth_token']
+                for call in responses.calls), set([jb_token.key]))
+        self.assertEqual(
+            sorted(SMS.objects.values_list('to', 'message_id')),
+            [('+27820', 'id-+27820'), ('+27821', 'id-+27821')])
+
+    @responses.activate
+    @override_settings(
+        SMS_CHANNEL='JUNEBUG',
+        JUNEBUG_CHANNEL_URL='https://example.com/junebug/CHANNEL_ID',
+        SMS_CODE='*11111')
+    def test_junebug_event_config_cached(self):
+        jb_user = User.objects.create_user('junebug')
+        Token.objects.create(user=jb_user)
+        responses.add(
+            responses.POST, 'https://example.com/junebug/CHANNEL_ID/messages/',
+            status=201, content_type='application/json',
+            body=json.dumps({'result': {'message_id': 'the-message-id'}}))
+
+        send_sms(to='+27111111111', content='test message')
+        # Only the SMS is written once the config has been looked up
+        with self.assertNumQueries(1):
+            send_sms(to='+27111111111', content='test message')
+
+        # Changing the token is picked up straight away
+        Token.objects.filter(user=jb_user).delete()
+        jb_token = Token.objects.create(user=jb_user)
+        send_sms(to='+27111111111', content='test message')
+        self.assertEqual(
+            json.loads(responses.calls[-1].request.body)['event_auth_token'],
+            jb_token.key)
+
+        # and so is changing the site
+        site = Site.objects.get_current()
+        site.domain = 'malaria.example.org'
+        site.save()
+        send_sms(to='+27111111111', content='test message')
+        self.assertEqual(
+            json.loads(responses.calls[-1].request.body)['event_url'],
+            'http://malaria.example.org/api/v1/event/')
+
+    @responses.activate
+    @override_settings(
+        SMS_CHANNEL='JUNEBUG',
+        JUNEBUG_CHANNEL_URL='https://example.com/junebug/CHANNEL_ID',
+        SMS_CODE='*11111', JUNEBUG_EVENT_CONFIG_TTL=-1)
+    def test_junebug_event_config_expires(self):
+        jb_user = User.objects.create_user('junebug')
+        Token.objects.create(user=jb_user)
+        responses.add(
+            responses.POST, 'https://example.com/junebug/CHANNEL_ID/messages/',
+            status=201, content_type='application/json',
+            body=json.dumps({'result': {'message_id': 'the-message-id'}}))
+
+        send_sms(to='+27111111111', content='test message')
+        with self.assertNumQueries(2):
+            send_sms(to='+27111111111', content='test message')
+
+    @responses.activate
+    def test_send_sms_batch_retries_failures(self):
+        def send(request):
+            data = json.loads(request.body)
+            if data['to_addr'] == '+27821':
+                return (500, {}, '')
+            return (200, {}, json.dumps({'message_id': 'the-message-id'}))
+        responses.remove(
+            responses.PUT,
+            ('http://go.vumi.org/api/v1/go/http_api_nostream/'
+             'VUMI_GO_CONVERSATION_KEY/messages.json'))
+        responses.add_callback(
+            responses.PUT,
+            ('http://go.vumi.org/api/v1/go/http_api_nostream/'
+             'VUMI_GO_CONVERSATION_KEY/messages.json'),
+            callback=send, content_type='application/json')
+
+        with patch.object(send_sms_batch, 'retry') as mock_retry:
+            mock_retry.return_value = Exception('retry')
+            with self.assertRaises(Exception):
+                send_sms_batch([['+27820', 'hi'], ['+27821', 'hi']])
+        mock_retry.assert_called_with(
+            args=[[['+27821', 'hi']]], countdown=30, max_retries=10)
+        [sms] = SMS.objects.all()
+        self.assertEqual(sms.to, '+27820')
+
     @responses.activate
     def test_get_data(self):
         case = self.mk_case(first_name="John", last_name="Day", gender="male",
@@ -566,3 +941,489 @@ class OnaTest(MalariaTestCase):
             compile_and_send_jembi(case.pk)
         case.refresh_from_db()
         self.assertFalse(case.jembi_alert_sent)
+
+
+class OutboxTest(MalariaTestCase):
+
+    def setUp(self):
+        super(OutboxTest, self).setUp()
+        responses.add(responses.GET, 'https://odk.ona.io/api/v1/data/79925',
+                      status=200, content_type='application/json',
+                      body=pkg_resources.resource_string(
+                          'malaria24', 'ona/fixtures/responses/data.json'))
+        post_save.disconnect(new_case_alert_jembi, sender=ReportedCase)
+
+    def tearDown(self):
+        super(OutboxTest, self).tearDown()
+        post_save.connect(new_case_alert_jembi, sender=ReportedCase)
+
+    @responses.activate
+    def test_import_writes_alerts_to_the_outbox(self):
+        form = OnaForm.objects.create(uuid='uuuid', form_id='79925',
+                                      active=True)
+        with patch.object(send_sms_batch, 'apply_async') as mock_send_sms:
+            with self.captureOnCommitCallbacks() as callbacks:
+                ona_fetch_reported_case_for_form(form.form_id)
+            # The confirmation SMSs to the reporters are queued with the
+            # cases, and only sent to the broker after the commit
+            self.assertEqual(OutboxMessage.objects.filter(
+                task=send_sms.name, dispatched_at__isnull=True).count(), 2)
+            self.assertFalse(mock_send_sms.called)
+            # One dispatch is sent for all of the messages
+            with patch.object(dispatch_outbox, 'delay',
+                              wraps=dispatch_outbox.delay) as mock_dispatch:
+                for callback in callbacks:
+                    callback()
+            self.assertEqual(mock_dispatch.call_count, 1)
+        # and both SMSs are sent in one batch
+        [(_, kwargs)] = mock_send_sms.call_args_list
+        [messages] = kwargs['args']
+        self.assertEqual(len(messages), 2)
+        self.assertFalse(OutboxMessage.objects.filter(
+            dispatched_at__isnull=True).exists())
+
+    def test_case_alerts_are_queued_together(self):
+        self.mk_ehp(name='EHP 1')
+        self.mk_ehp(name='EHP 2')
+        self.mk_ci()
+        with patch.object(dispatch_outbox, 'delay'), \
+                CaptureQueriesContext(connection) as queries:
+            self.mk_case()
+        # Two SMSs and emails for the EHPs and the reporter's SMS in one
+        # insert, and the case investigator's SMS in another
+        self.assertEqual(OutboxMessage.objects.count(), 6)
+        self.assertEqual(len([
+            query for query in queries.captured_queries
+            if query['sql'].startswith(
+                'INSERT INTO "ona_outboxmessage"')]), 2)
+
+    def test_rolled_back_alerts_are_not_sent(self):
+        with patch.object(send_sms_batch, 'apply_async') as mock_send_sms:
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        # Not mk_case, which runs the commit callbacks
+                        ReportedCase.objects.create(
+                            date_of_birth='900101', create_date_time=now(),
+                            gender='female', facility_code='123456',
+                            reported_by='+27721111111', _uuid='the-uuid')
+                        self.assertEqual(OutboxMessage.objects.count(), 1)
+                        raise IntegrityError()
+                except IntegrityError:
+                    pass
+            dispatch_outbox()
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+        self.assertFalse(mock_send_sms.called)
+
+    def test_dispatch_outbox(self):
+        for i in range(5):
+            OutboxMessage.enqueue(compile_and_send_jembi, i)
+        with patch.object(compile_and_send_jembi, 'apply_async') as mock_send:
+            self.assertEqual(dispatch_outbox(batch_size=2), 5)
+            self.assertEqual(dispatch_outbox(batch_size=2), 0)
+        self.assertEqual(mock_send.call_count, 5)
+        mock_send.assert_called_with(args=[4], kwargs={})
+
+    @override_settings(EMAIL_BATCH_SIZE=3)
+    def test_dispatch_outbox_batches_case_emails(self):
+        for i in range(4):
+            OutboxMessage.enqueue(
+                send_case_email, i, ['ehp%s@example.org' % (i,)])
+        OutboxMessage.enqueue(
+            send_case_email, case_pk=4, recipients=['mis@example.org'])
+        with patch.object(send_case_email_batch, 'apply_async') as mock_send:
+            self.assertEqual(dispatch_outbox(), 5)
+        self.assertEqual(
+            [kwargs['args'] for _, kwargs in mock_send.call_args_list], [
+                [[[0, ['ehp0@example.org']], [1, ['ehp1@example.org']],
+                  [2, ['ehp2@example.org']]]],
+                [[[3, ['ehp3@example.org']], [4, ['mis@example.org']]]],
+            ])
+
+    def test_send_case_email_batch(self):
+        case1 = self.mk_case(first_name='Case 1')
+        case2 = self.mk_case(first_name='Case 2')
+        mail.outbox = []
+        with patch.object(tasks, 'make_pdf') as mock_make_pdf, \
+                patch.object(tasks, 'get_connection',
+                             wraps=tasks.get_connection) as mock_connection:
+            mock_make_pdf.return_value = 'garbage for testing'
+            with LogCapture() as log:
+                send_case_email_batch([
+                    [case1.pk, ['ehp1@example.org']],
+                    [case1.pk, ['ehp2@example.org']],
+                    [case2.pk, ['ehp3@example.org']],
+                    [case2.pk + 1, ['ehp4@example.org']],
+                ])
+        self.assertEqual(mock_connection.call_count, 1)
+        self.assertEqual(mock_make_pdf.call_count, 2)
+        self.assertEqual(
+            [message.to for message in mail.outbox],
+            [['ehp1@example.org'], ['ehp2@example.org'],
+             ['ehp3@example.org']])
+        # Both emails for a case share their recorded content
+        self.assertEqual(
+            sorted(Email.objects.values_list('to', 'content__html_content')),
+            [('ehp1@example.org', case1.get_html_email_content()),
+             ('ehp2@example.org', case1.get_html_email_content()),
+             ('ehp3@example.org', case2.get_html_email_content())])
+        self.assertEqual(EmailContent.objects.count(), 2)
+        self.assertIn(
+            'Not emailing case %s to ehp4@example.org, it was deleted.' % (
+                case2.pk + 1,),
+            [record.getMessage() for record in log.records])
+
+    def test_send_case_email_batch_failures(self):
+        case = self.mk_case()
+        mail.outbox = []
+        connection = mail.get_connection()
+        send_messages = connection.send_messages
+
+        def fail_some(messages):
+            [to] = messages[0].to
+            if to == 'refused@example.org':
+                raise smtplib.SMTPRecipientsRefused({
+                    to: (550, b'No such user')})
+            if to == 'later@example.org':
+                raise smtplib.SMTPDataError(451, b'Try again later')
+            return send_messages(messages)
+
+        connection.send_messages = fail_some
+        with patch.object(tasks, 'make_pdf') as mock_make_pdf, \
+                patch.object(tasks, 'get_connection',
+                             return_value=connection), \
+                patch.object(send_case_email_batch, 'retry') as mock_retry:
+            mock_make_pdf.return_value = 'garbage for testing'
+            mock_retry.return_value = Exception('retry')
+            with self.assertRaises(Exception):
+                send_case_email_batch([
+                    [case.pk, ['refused@example.org']],
+                    [case.pk, ['later@example.org']],
+                    [case.pk, ['ehp@example.org']],
+                ])
+        # The failures don't stop the rest being sent and recorded
+        self.assertEqual(
+            [message.to for message in mail.outbox], [['ehp@example.org']])
+        self.assertEqual(
+            list(Email.objects.values_list('to', flat=True)),
+            ['ehp@example.org'])
+        # Only the temporary failure is retried
+        mock_retry.assert_called_with(
+            args=[[[case.pk, ['later@example.org']]]], countdown=60,
+            max_retries=5)
+
+    @override_settings(EMAIL_MAX_RETRIES=1, EMAIL_RETRY_BACKOFF=0)
+    def test_send_case_email_batch_gives_up(self):
+        case = self.mk_case()
+        mail.outbox = []
+        with patch.object(tasks, 'make_pdf') as mock_make_pdf, \
+                patch.object(tasks, 'get_connection') as mock_connection:
+            mock_make_pdf.return_value = 'garbage for testing'
+            mock_connection.side_effect = smtplib.SMTPConnectError(
+                421, b'Unavailable')
+            with LogCapture() as log:
+                send_case_email_batch.delay(
+                    [[case.pk, ['ehp@example.org']]])
+        self.assertEqual(mock_connection.call_count, 2)
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertIn(
+            'Giving up on emailing case %s to ehp@example.org.' % (case.pk,),
+            [record.getMessage() for record in log.records])
+
+    @override_settings(SMS_BATCH_SIZE=3)
+    def test_dispatch_outbox_batches_sms(self):
+        for i in range(5):
+            OutboxMessage.enqueue(send_sms, to='+2782%s' % (i,), content='hi')
+        OutboxMessage.enqueue(send_sms, '+27825', 'bye')
+        with patch.object(send_sms_batch, 'apply_async') as mock_send_sms:
+            self.assertEqual(dispatch_outbox(), 6)
+        self.assertEqual(
+            [kwargs['args'] for _, kwargs in mock_send_sms.call_args_list], [
+                [[['+27820', 'hi'], ['+27821', 'hi'], ['+27822', 'hi']]],
+                [[['+27823', 'hi'], ['+27824', 'hi'], ['+27825', 'bye']]],
+            ])
+
+    def test_dispatch_outbox_failure(self):
+        OutboxMessage.enqueue(send_sms, to='+27821', content='hi')
+        with patch.object(send_sms_batch, 'apply_async') as mock_send_sms:
+            mock_send_sms.side_effect = Exception('broker down')
+            with LogCapture() as log:
+                self.assertEqual(dispatch_outbox(), 0)
+        [message] = OutboxMessage.objects.all()
+        self.assertEqual(message.dispatched_at, None)
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(message.last_error, "Exception('broker down')")
+        # The claim is released so the next dispatch tries it again
+        self.assertEqual(message.claimed_at, None)
+        self.assertIn(
+            'Unable to dispatch outbox message %s: broker down' % (
+                message.pk,),
+            [record.getMessage() for record in log.records])
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_dispatch_outbox_skips_failing_messages(self):
+        bad = OutboxMessage.objects.create(task='ona.tasks.unknown')
+        OutboxMessage.enqueue(compile_and_send_jembi, 1)
+        with patch.object(compile_and_send_jembi, 'apply_async') as mock_send:
+            self.assertEqual(dispatch_outbox(), 1)
+            OutboxMessage.enqueue(compile_and_send_jembi, 2)
+            self.assertEqual(dispatch_outbox(), 1)
+            # The failing message is left alone after too many attempts
+            OutboxMessage.enqueue(compile_and_send_jembi, 3)
+            self.assertEqual(dispatch_outbox(), 1)
+        self.assertEqual(
+            [call[1]['args'] for call in mock_send.call_args_list],
+            [[1], [2], [3]])
+        bad.refresh_from_db()
+        self.assertEqual(bad.dispatched_at, None)
+        self.assertEqual(bad.attempts, 2)
+        self.assertIn('ona.tasks.unknown', bad.last_error)
+
+    @override_settings(OUTBOX_CLAIM_TIMEOUT=300)
+    def test_dispatch_outbox_claims(self):
+        claimed = OutboxMessage.objects.create(
+            task=compile_and_send_jembi.name, args=[1],
+            claimed_at=now() - timedelta(seconds=60))
+        expired = OutboxMessage.objects.create(
+            task=compile_and_send_jembi.name, args=[2],
+            claimed_at=now() - timedelta(seconds=600))
+        OutboxMessage.objects.create(
+            task=compile_and_send_jembi.name, args=[3])
+
+        def check_claimed(args, kwargs):
+            # The batch is claimed before anything is published
+            self.assertFalse(OutboxMessage.objects.filter(
+                claimed_at__isnull=True).exists())
+
+        with patch.object(compile_and_send_jembi, 'apply_async') as mock_send:
+            mock_send.side_effect = check_claimed
+            self.assertEqual(dispatch_outbox(), 2)
+        # Another dispatcher is still busy with the first message
+        self.assertEqual(
+            [call[1]['args'] for call in mock_send.call_args_list],
+            [[2], [3]])
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.dispatched_at, None)
+        expired.refresh_from_db()
+        self.assertNotEqual(expired.dispatched_at, None)
+
+    @override_settings(OUTBOX_RETENTION_DAYS=7)
+    def test_purge_outbox(self):
+        for days in [None, 1, 8]:
+            OutboxMessage.objects.create(
+                task=send_sms.name, args=[days],
+                dispatched_at=days and now() - timedelta(days=days))
+        self.assertEqual(purge_outbox(), 1)
+        self.assertEqual(
+            sorted(OutboxMessage.objects.values_list('args', flat=True),
+                   key=str),
+            [[1], [None]])
+
+    def test_schedule_dispatch_broker_failure(self):
+        with patch.object(dispatch_outbox, 'delay') as mock_dispatch:
+            mock_dispatch.side_effect = Exception('broker down')
+            with LogCapture() as log:
+                with self.captureOnCommitCallbacks(execute=True):
+                    OutboxMessage.enqueue(compile_and_send_jembi, 1)
+        # The message is left for the periodic dispatch
+        self.assertTrue(OutboxMessage.objects.filter(
+            dispatched_at__isnull=True).exists())
+        self.assertIn(
+            'Unable to schedule an outbox dispatch: broker down',
+            [record.getMessage() for record in log.records])
+
+
+VUMI_GO_URL = ('http://go.vumi.org/api/v1/go/http_api_nostream/'
+               'VUMI_GO_CONVERSATION_KEY/messages.json')
+
+
+class RateLimiterTest(MalariaTestCase):
+
+    def setUp(self):
+        super(RateLimiterTest, self).setUp()
+        ratelimit._stores.clear()
+
+    def tearDown(self):
+        super(RateLimiterTest, self).tearDown()
+        ratelimit._stores.clear()
+
+    def test_token_bucket(self):
+        limiter = RateLimiter('test', 10, 2, LocalBucketStore())
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(limiter.acquire(), 0)
+        wait = limiter.acquire()
+        self.assertTrue(0 < wait <= 0.1)
+        self.assertEqual(limiter.stats(), {'waiting': 0, 'throttled': 1})
+        # Waiting for long enough gets a token
+        self.assertEqual(limiter.acquire(max_wait=1), 0)
+        self.assertEqual(limiter.stats(), {'waiting': 0, 'throttled': 1})
+
+    @responses.activate
+    @override_settings(
+        SMS_RATE_LIMITS={'VUMI_GO': {'rate': 0.01, 'capacity': 2}},
+        SMS_RATE_LIMIT_MAX_WAIT=0, SMS_BATCH_CONCURRENCY=1)
+    def test_send_sms_batch_throttled(self):
+        with patch.object(send_sms_batch, 'retry') as mock_retry:
+            mock_retry.return_value = Exception('retry')
+            with self.assertRaises(Exception):
+                send_sms_batch([['+27820', 'hi'], ['+27821', 'hi'],
+                                ['+27822', 'hi']])
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(SMS.objects.count(), 2)
+        (_, kwargs), = mock_retry.call_args_list
+        self.assertEqual(kwargs['args'], [[['+27822', 'hi']]])
+        # Retried once a token is expected to be available
+        self.assertTrue(90 < kwargs['countdown'] <= 100)
+
+    @responses.activate
+    def test_send_sms_batch_retry_after(self):
+        responses.remove(responses.PUT, VUMI_GO_URL)
+        responses.add(responses.PUT, VUMI_GO_URL, status=429,
+                      headers={'Retry-After': '120'})
+        with patch.object(send_sms_batch, 'retry') as mock_retry:
+            mock_retry.return_value = Exception('retry')
+            with self.assertRaises(Exception):
+                send_sms_batch([['+27820', 'hi']])
+        mock_retry.assert_called_with(
+            args=[[['+27820', 'hi']]], countdown=120, max_retries=10)
+
+    @responses.activate
+    def test_send_sms_batch_bad_request_not_retried(self):
+        responses.remove(responses.PUT, VUMI_GO_URL)
+        responses.add(responses.PUT, VUMI_GO_URL, status=400)
+        with patch.object(send_sms_batch, 'retry') as mock_retry:
+            with LogCapture() as log:
+                send_sms_batch([['+27820', 'hi']])
+        self.assertFalse(mock_retry.called)
+        self.assertEqual(SMS.objects.count(), 0)
+        self.assertTrue(any(
+            record.getMessage().startswith('Unable to send SMS to +27820: ')
+            for record in log.records))
+
+    @responses.activate
+    def test_send_sms_batch_gives_up(self):
+        responses.remove(responses.PUT, VUMI_GO_URL)
+        responses.add(responses.PUT, VUMI_GO_URL, status=503)
+        with override_settings(SMS_MAX_RETRIES=2, SMS_RETRY_BACKOFF=0):
+            with LogCapture() as log:
+                send_sms_batch.delay([['+27820', 'hi']])
+        # The first attempt and two retries
+        self.assertEqual(len(responses.calls), 3)
+        self.assertIn(
+            'Giving up on sending SMS to +27820.',
+            [record.getMessage() for record in log.records])
+
+
+# Stands in for wkhtmltopdf, echoing the HTML back after a PDF header
+FAKE_WKHTMLTOPDF = [sys.executable, '-c', (
+    'import sys, time; html = sys.stdin.read(); time.sleep(0.1);'
+    'sys.stdout.write("%PDF-" + html if html else "")')]
+
+
+class PDFRenderPoolTest(MalariaTestCase):
+
+    def setUp(self):
+        super(PDFRenderPoolTest, self).setUp()
+        self.pool = PDFRenderPool(2, FAKE_WKHTMLTOPDF)
+        self.pool.start()
+        self.addCleanup(self.pool.close)
+
+    def test_render(self):
+        self.assertEqual(self.pool.render('<p>hi</p>'), b'%PDF-<p>hi</p>')
+
+    def test_render_error(self):
+        with self.assertRaises(PDFRenderError):
+            self.pool.render('')
+
+    def test_render_is_bounded(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda i=i: results.append(
+                self.pool.render('%s' % (i,))))
+            for i in range(4)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Four renders two at a time take at least two rounds
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(
+            sorted(results), [b'%PDF-0', b'%PDF-1', b'%PDF-2', b'%PDF-3'])
+
+    def test_render_timeout(self):
+        pool = PDFRenderPool(1, FAKE_WKHTMLTOPDF, timeout=0.01)
+        pool.start()
+        self.addCleanup(pool.close)
+        with self.assertRaises(PDFRenderError):
+            pool.render('<p>hi</p>')
+
+
+# Stands in for Xvfb, reporting a display number and then waiting
+FAKE_XVFB = """#!%s
+import os, sys, time
+fd = int(sys.argv[sys.argv.index('-displayfd') + 1])
+os.write(fd, b'99\\n')
+time.sleep(60)
+""" % (sys.executable,)
+
+# Starts a display and leaves without stopping it, like a Celery child
+START_XVFB_AND_EXIT = """
+import os, sys
+from malaria24.ona.pdf import XvfbDisplay
+display = XvfbDisplay(command=sys.argv[1])
+display.start()
+print(display.display, display.process.pid, flush=True)
+os._exit(0)
+"""
+
+
+def process_running(pid):
+    try:
+        with open('/proc/%s/stat' % (pid,)) as fp:
+            state = fp.read().rsplit(')', 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state != 'Z'
+
+
+@skipUnless(sys.platform.startswith('linux'), 'Needs PR_SET_PDEATHSIG')
+class XvfbDisplayTest(MalariaTestCase):
+
+    def test_display_stops_with_its_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            script = os.path.join(directory, 'Xvfb')
+            with open(script, 'w') as fp:
+                fp.write(FAKE_XVFB)
+            os.chmod(script, 0o700)
+            output = subprocess.check_output(
+                [sys.executable, '-c', START_XVFB_AND_EXIT, script],
+                timeout=30)
+        display, pid = output.decode('utf-8').split()
+        self.assertEqual(display, ':99')
+        deadline = time.time() + 10
+        while process_running(pid) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(process_running(pid))
+
+    def test_display_not_tied_to_other_threads(self):
+        # The kernel would stop it as soon as this thread finished
+        preexec_fns = []
+        thread = threading.Thread(
+            target=lambda: preexec_fns.append(pdf.get_die_with_parent()))
+        thread.start()
+        thread.join()
+        self.assertEqual(preexec_fns, [None])
+        self.assertNotEqual(pdf.get_die_with_parent(), None)
+
+    def test_pool_started_on_worker_process_init(self):
+        with patch.object(pdf, 'get_pdf_pool') as mock_get_pdf_pool:
+            worker_process_init.send(sender=None)
+        mock_get_pdf_pool.assert_called_with()
+
+    def test_pool_closed_on_worker_process_shutdown(self):
+        with patch.object(pdf, '_pool') as pool:
+            worker_process_shutdown.send(
+                sender=None, pid=os.getpid(), exitcode=0)
+            self.assertEqual(pdf._pool, None)
+        pool.close.assert_called_with()
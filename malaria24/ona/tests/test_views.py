@@ -75,6 +75,9 @@ class FacilityTest(MalariaTestCase):
         original_facility = Facility.objects.create(
             facility_code='123456',
             facility_name='The Old Name')
+        Facility.objects.create(
+            facility_code='654321',
+            facility_name='Not In The Upload')
         self.client.post(reverse('admin:ona_facility_upload'), {
             'upload': StringIO(json.dumps([{
                 "District": "District",
@@ -90,7 +93,8 @@ class FacilityTest(MalariaTestCase):
         [facility] = Facility.objects.all()
         self.assertEqual(facility.facility_code, '123456')
         self.assertEqual(facility.facility_name, 'Facility Name')
-        self.assertNotEqual(facility.pk, original_facility.pk)
+        # Facilities in the upload are updated rather than recreated
+        self.assertEqual(facility.pk, original_facility.pk)
 
     @responses.activate
     def test_admin_ehp_email(self):
@@ -89,12 +89,82 @@ CELERYBEAT_SCHEDULE = {
         'task': 'malaria24.ona.tasks.ona_fetch_reported_cases',
         'schedule': timedelta(minutes=10),
     },
+    'dispatch-outbox': {
+        'task': 'malaria24.ona.tasks.dispatch_outbox',
+        'schedule': timedelta(minutes=1),
+    },
+    'purge-outbox': {
+        'task': 'malaria24.ona.tasks.purge_outbox',
+        'schedule': crontab(hour=2, minute=30),
+    },
     'send-weekly-digest': {
         'task': 'malaria24.ona.tasks.compile_and_send_digest_email',
         'schedule': crontab(hour=8, minute=15, day_of_week='mon'),
     },
 }
 
+# Number of Ona submissions fetched and imported per request
+ONA_DATA_PAGE_SIZE = 1000
+# Number of keep-alive connections each worker keeps open to Ona
+ONA_CONNECTION_POOL_SIZE = 10
+# Number of outbox messages claimed and sent to the broker at a time
+OUTBOX_BATCH_SIZE = 500
+# Number of times an outbox message is tried before it's left undispatched
+OUTBOX_MAX_ATTEMPTS = 10
+# Seconds a dispatcher has to send the outbox messages it claimed before
+# another dispatcher may claim them again
+OUTBOX_CLAIM_TIMEOUT = 300
+# Number of days dispatched outbox messages are kept before being purged
+OUTBOX_RETENTION_DAYS = 7
+# Number of SMSs sent per batch task, and how many of those are in
+# flight at a time
+SMS_BATCH_SIZE = 100
+SMS_BATCH_CONCURRENCY = 10
+# Number of case emails sent over one SMTP connection
+EMAIL_BATCH_SIZE = 50
+# Retries, with exponential backoff in seconds, for failed case emails
+EMAIL_MAX_RETRIES = 5
+EMAIL_RETRY_BACKOFF = 60
+EMAIL_RETRY_BACKOFF_MAX = 1800
+# Seconds the Junebug event URL and token are kept by each process
+JUNEBUG_EVENT_CONFIG_TTL = 300
+# Maximum sustained SMSs per second and burst size for each SMS_CHANNEL.
+# The limits are shared by all the workers through
+# SMS_RATE_LIMIT_REDIS_URL, or apply to each process if that isn't set
+SMS_RATE_LIMITS = {
+    'VUMI_GO': {'rate': 10, 'capacity': 20},
+    'JUNEBUG': {'rate': 10, 'capacity': 20},
+}
+SMS_RATE_LIMIT_REDIS_URL = None
+# Seconds a send waits for the rate limiter before it is retried later
+SMS_RATE_LIMIT_MAX_WAIT = 10
+# Retries, with exponential backoff in seconds, for throttled or failed SMSs
+SMS_MAX_RETRIES = 10
+SMS_RETRY_BACKOFF = 30
+SMS_RETRY_BACKOFF_MAX = 600
+# The number of PDFs each worker process renders at once
+PDF_RENDER_WORKERS = 2
+# The wkhtmltopdf command, HTML is piped in and the PDF read back
+PDF_RENDER_COMMAND = ['wkhtmltopdf']
+# Seconds to allow for rendering a PDF
+PDF_RENDER_TIMEOUT = 60
+# Start one Xvfb display per process for the renders to share
+PDF_RENDER_XVFB = False
+
+# The case_email cache shares the rendered case emails and PDFs between
+# the tasks sending them to each recipient
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'case_email': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'case_email',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 200},
+    },
+}
+
 DEFAULT_FROM_EMAIL = 'MalariaConnect <malaria24@praekelt.com>'
 
 # JEMBI settings
@@ -13,6 +13,19 @@ DEBUG = False
 COMPRESS_OFFLINE = True
 
 BROKER_URL = environ.get('BROKER_URL') or BROKER_URL
+SMS_RATE_LIMIT_REDIS_URL = environ.get('SMS_RATE_LIMIT_REDIS_URL') or (
+    BROKER_URL if BROKER_URL.startswith('redis') else None)
+
+# The render pool keeps its own display for wkhtmltopdf
+PDF_RENDER_XVFB = True
+
+# Share the rendered case emails between the worker processes on disk
+CACHES['case_email'].update({
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': environ.get(
+        'CASE_EMAIL_CACHE_DIR', '/tmp/malaria24-case-email'),
+    'OPTIONS': {'MAX_ENTRIES': 2000},
+})
 
 DATABASES = {
     'default': dj_database_url.config(
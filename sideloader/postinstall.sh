@@ -1,8 +1,6 @@
 cd "${INSTALLDIR}/${NAME}/malaria24/"
 manage="${VENV}/bin/python ${INSTALLDIR}/${NAME}/manage.py"
 
-pip install git+git://github.com/onaio/onapie.git#egg=onapie
-
 $manage migrate --noinput --settings=malaria24.settings.production
 
 # process static files